@@ -0,0 +1,71 @@
+import json
+import logging
+import sqlite3
+from threading import Lock
+from typing import List, Tuple
+
+class FaceAnalysis:
+    # Face boxes are stored as fractions of the image size so they can be reused
+    # whatever size the image gets rendered at. Boxes are (top, right, bottom, left)
+    # like face_recognition returns them; crop is (left, top, right, bottom).
+    def __init__(self, faces: List[Tuple[float, float, float, float]], crop=None, screenSize=None):
+        self.faces = faces
+        self.crop = crop
+        self.screenSize = screenSize
+
+    @property
+    def numFaces(self) -> int:
+        return len(self.faces)
+
+    def facesForSize(self, size) -> List[Tuple[int, int, int, int]]:
+        return [(round(top * size[1]), round(right * size[0]), round(bottom * size[1]), round(left * size[0]))
+                for top, right, bottom, left in self.faces]
+
+    @staticmethod
+    def fromLocations(locations, size) -> 'FaceAnalysis':
+        return FaceAnalysis([(top / size[1], right / size[0], bottom / size[1], left / size[0])
+                             for top, right, bottom, left in locations])
+
+class AnalysisCache:
+    # Persistent face analysis results, keyed by asset id. The checksum is stored
+    # alongside so an asset that was edited on the server gets analysed again.
+    def __init__(self, dbPath: str) -> None:
+        self.lock = Lock()
+        self.db = sqlite3.connect(dbPath, check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS analysis (
+            assetId TEXT PRIMARY KEY,
+            checksum TEXT,
+            numFaces INTEGER,
+            faces TEXT,
+            crop TEXT,
+            screenSize TEXT,
+            upright INTEGER DEFAULT 0)""")
+        # analyses written before photos were turned upright before detection
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(analysis)")]
+        if "upright" not in columns:
+            self.db.execute("ALTER TABLE analysis ADD COLUMN upright INTEGER DEFAULT 0")
+        self.db.commit()
+        logging.info(f"Face analysis cache at {dbPath}")
+
+    def get(self, assetId: str, checksum: str, rotated: bool = False) -> FaceAnalysis:
+        # rotated photos were analysed on their side before they were turned
+        # upright, so only trust analyses that were done the right way up
+        with self.lock:
+            row = self.db.execute("SELECT checksum, faces, crop, screenSize, upright FROM analysis WHERE assetId = ?", (assetId,)).fetchone()
+        if row is None or row[0] != checksum or (rotated and not row[4]):
+            return None
+        crop = json.loads(row[2]) if row[2] else None
+        screenSize = json.loads(row[3]) if row[3] else None
+        return FaceAnalysis([tuple(face) for face in json.loads(row[1])], crop, screenSize)
+
+    def put(self, assetId: str, checksum: str, analysis: FaceAnalysis):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO analysis (assetId, checksum, numFaces, faces, crop, screenSize, upright) VALUES (?, ?, ?, ?, ?, ?, 1)",
+                            (assetId, checksum, analysis.numFaces, json.dumps(analysis.faces),
+                             json.dumps(analysis.crop) if analysis.crop else None,
+                             json.dumps(analysis.screenSize) if analysis.screenSize else None))
+            self.db.commit()
+
+    def cleanup(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,132 @@
+import json
+import logging
+import sqlite3
+from threading import Lock
+from typing import Dict, List
+
+from Downloader import Downloader, Photo
+
+class AssetCatalog:
+    # Local copy of the library's timeline: the month buckets with their counts,
+    # and the metadata of every asset we've listed. On startup only the bucket
+    # list is fetched; a bucket's assets are fetched again only when its count
+    # on the server no longer matches what we listed last time.
+    def __init__(self, dbPath: str) -> None:
+        self.lock = Lock()
+        self.db = sqlite3.connect(dbPath, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS buckets (
+                timeBucket TEXT PRIMARY KEY,
+                count INTEGER,
+                listedCount INTEGER);
+            CREATE TABLE IF NOT EXISTS assets (
+                id TEXT PRIMARY KEY,
+                timeBucket TEXT,
+                filename TEXT,
+                width INTEGER,
+                height INTEGER,
+                fileCreatedAt TEXT,
+                checksum TEXT,
+                type TEXT,
+                deleted INTEGER DEFAULT 0,
+                asset TEXT);
+            CREATE INDEX IF NOT EXISTS assetsByBucket ON assets (timeBucket, deleted);
+            """)
+        self.db.commit()
+        logging.info(f"Asset catalog at {dbPath}")
+
+    def sync(self, downloader: Downloader) -> List[Dict[str, object]]:
+        # refresh the bucket list from the server, and return it. Buckets whose
+        # count changed keep their old listedCount, which marks them as stale.
+        remoteBuckets = downloader.getTimelineBuckets()
+        with self.lock:
+            localBuckets = dict(self.db.execute("SELECT timeBucket, count FROM buckets").fetchall())
+            remoteNames = set()
+            changed = 0
+            for bucket in remoteBuckets:
+                name = bucket["timeBucket"]
+                remoteNames.add(name)
+                if localBuckets.get(name) != bucket["count"]:
+                    changed += 1
+                self.db.execute("INSERT INTO buckets (timeBucket, count, listedCount) VALUES (?, ?, -1) "
+                                "ON CONFLICT(timeBucket) DO UPDATE SET count = excluded.count", (name, bucket["count"]))
+
+            # buckets that disappeared from the server take all their assets with them
+            removed = [name for name in localBuckets if name not in remoteNames]
+            for name in removed:
+                self.db.execute("UPDATE assets SET deleted = 1 WHERE timeBucket = ?", (name,))
+                self.db.execute("DELETE FROM buckets WHERE timeBucket = ?", (name,))
+            self.db.commit()
+        logging.info(f"Catalog synced: {len(remoteBuckets)} buckets, {changed} changed, {len(removed)} removed")
+        return remoteBuckets
+
+    def listStaleBuckets(self, downloader: Downloader, batchSize: int = 16):
+        # list the buckets that changed since last time up front, batchSize at a time.
+        # Only worth it for downloaders that can list concurrently. Buckets that fail
+        # stay stale and get listed when the sampler first needs them
+        with self.lock:
+            rows = self.db.execute("SELECT timeBucket, count FROM buckets WHERE count != listedCount").fetchall()
+        listed = 0
+        for start in range(0, len(rows), batchSize):
+            counts = dict(rows[start:start + batchSize])
+            for bucketName, photos in downloader.getPhotosForBuckets(list(counts.keys())).items():
+                self._store_bucket(bucketName, photos, counts[bucketName])
+                listed += 1
+        if listed < len(rows):
+            logging.warning(f"Listed {listed} of {len(rows)} stale buckets, the rest will be listed when needed")
+
+    def getPhotosForBucket(self, bucketName: str, downloader: Downloader) -> List[Photo]:
+        with self.lock:
+            row = self.db.execute("SELECT count, listedCount FROM buckets WHERE timeBucket = ?", (bucketName,)).fetchone()
+        if row is not None and row[0] == row[1]:
+            return self._load_bucket(bucketName, downloader)
+
+        try:
+            photos = downloader.getPhotosForBucket(bucketName)
+        except Exception as e:
+            # make do with what we listed last time, and try again next pass
+            logging.error(f"Could not list bucket {bucketName}: {e}")
+            return self._load_bucket(bucketName, downloader)
+        self._store_bucket(bucketName, photos, row[0] if row else len(photos))
+        return photos
+
+    def _load_bucket(self, bucketName: str, downloader: Downloader) -> List[Photo]:
+        with self.lock:
+            rows = self.db.execute("SELECT asset FROM assets WHERE timeBucket = ? AND deleted = 0", (bucketName,)).fetchall()
+        return [Photo(json.loads(row[0]), downloader) for row in rows]
+
+    def _store_bucket(self, bucketName: str, photos: List[Photo], count: int):
+        with self.lock:
+            known = set(row[0] for row in self.db.execute("SELECT id FROM assets WHERE timeBucket = ? AND deleted = 0", (bucketName,)))
+            for photo in photos:
+                try:
+                    width, height = photo.dimensions
+                except (KeyError, TypeError):
+                    width, height = 0, 0
+                self.db.execute("INSERT OR REPLACE INTO assets (id, timeBucket, filename, width, height, fileCreatedAt, checksum, type, deleted, asset) "
+                                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, ?)",
+                                (photo.id, bucketName, photo.filename, width, height, photo.created, photo.checksum,
+                                 photo.photo.get("type"), json.dumps(photo.photo)))
+                known.discard(photo.id)
+
+            # whatever we knew about in this bucket and didn't get back was deleted on the server
+            for assetId in known:
+                self.db.execute("UPDATE assets SET deleted = 1 WHERE id = ?", (assetId,))
+            self.db.execute("UPDATE buckets SET listedCount = ? WHERE timeBucket = ?", (count, bucketName))
+            self.db.commit()
+        logging.info(f"Catalog listed bucket {bucketName}: {len(photos)} assets, {len(known)} deleted")
+
+    @property
+    def deletedIds(self) -> List[str]:
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT id FROM assets WHERE deleted = 1")]
+
+    def purgeDeleted(self, assetIds: List[str]):
+        # forget deleted assets once they've been dealt with
+        with self.lock:
+            self.db.executemany("DELETE FROM assets WHERE id = ? AND deleted = 1", [(assetId,) for assetId in assetIds])
+            self.db.commit()
+
+    def cleanup(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import tempfile
+import time
+from threading import Thread
+from typing import Dict, List
+
+import aiohttp
+from PIL import Image
+
+from Downloader import Photo
+from ImmichDownloader import ImmichDownloader
+from Constants import CONFIG_CONCURRENT_REQUESTS
+
+class AsyncImmichDownloader(ImmichDownloader):
+  # ImmichDownloader that makes its listing and download requests with aiohttp
+  # on an event loop running in a background thread. The synchronous Downloader
+  # methods hand their coroutine to that loop and wait for the result, so
+  # PhotoProcessor drives it like any other downloader, while several pipeline
+  # workers (or getPhotosForBuckets) can have requests in flight at once.
+  concurrentListing = True
+
+  def __init__(self, config) -> None:
+    super().__init__(config)
+    if CONFIG_CONCURRENT_REQUESTS in config:
+      self.concurrency = config[CONFIG_CONCURRENT_REQUESTS]
+    else:
+      self.concurrency = 8
+    self.loop = asyncio.new_event_loop()
+    self.loopThread = Thread(target=self.loop.run_forever, name="immich-async", daemon=True)
+    self.loopThread.start()
+    self.httpSession: aiohttp.ClientSession = self._run(self._create_http_session())
+
+  async def _create_http_session(self) -> aiohttp.ClientSession:
+    self.semaphore = asyncio.Semaphore(self.concurrency)
+    connector = aiohttp.TCPConnector(limit=self.concurrency)
+    timeout = aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1])
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+  def _run(self, coroutine):
+    return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+  async def _fetch(self, url, handler, headers = None):
+    # same contract as ImmichDownloader._request: rate limited, and one retry
+    # after logging in again if the token has expired
+    for attempt in range(2):
+      token = self.accessToken
+      async with self.semaphore:
+        await self.loop.run_in_executor(None, self.rateLimiter.acquire)
+        start = time.monotonic()
+        async with self.httpSession.get(url, headers={**(headers or {}), "Authorization": f"Bearer {token}"}) as response:
+          self.rateLimiter.onResponse(response.status, time.monotonic() - start, response.headers.get("Retry-After"))
+          if response.status == 401 and attempt == 0 and self.credentials is not None:
+            logging.info("Access token rejected, logging in again")
+          else:
+            response.raise_for_status()
+            return await handler(response)
+      await self.loop.run_in_executor(None, self._relogin, token)
+
+  async def _read_json(self, response):
+    return await response.json()
+
+  async def _get_photos_for_bucket(self, bucket_id: str) -> List[Photo]:
+    photos = await self._fetch(self._bucket_url(bucket_id), self._read_json)
+    return [Photo(photo, self) for photo in photos]
+
+  def getTimelineBuckets(self) -> List[Dict[str, object]]:
+    self.timelineBuckets = self._run(self._fetch(self._buckets_url(), self._read_json))
+    return self.timelineBuckets
+
+  def getPhotosForBucket(self, bucket_id: str) -> List[Photo]:
+    return self._run(self._get_photos_for_bucket(bucket_id))
+
+  def getPhotosForBuckets(self, bucketNames: List[str]) -> Dict[str, List[Photo]]:
+    async def listAll():
+      results = await asyncio.gather(*[self._get_photos_for_bucket(name) for name in bucketNames], return_exceptions=True)
+      return dict(zip(bucketNames, results))
+    start = time.monotonic()
+    result = dict()
+    for name, photos in self._run(listAll()).items():
+      if isinstance(photos, Exception):
+        logging.error(f"Could not list bucket {name}: {photos}")
+      else:
+        result[name] = photos
+    logging.info(f"Listed {len(result)} of {len(bucketNames)} buckets in {time.monotonic() - start:.1f}s")
+    return result
+
+  def downloadPhoto(self, photo, destination = None):
+    rendition = self._pick_rendition(photo)
+    photo_url = self._photo_url(photo, rendition)
+
+    async def save(response):
+      if response.status == 304:
+        return None
+      self._store_etag(photo_url, response.headers.get("ETag"))
+      if destination is None:
+        buffer = tempfile.SpooledTemporaryFile(max_size=self.spoolThreshold)
+      else:
+        buffer = open(destination, 'wb')
+      numBytes = 0
+      async for chunk in response.content.iter_chunked(65536):
+        buffer.write(chunk)
+        numBytes += len(chunk)
+      self._record_download(photo, rendition, numBytes)
+      return buffer
+
+    buffer = self._run(self._fetch(photo_url, save, self._conditional_headers(photo_url, destination)))
+    if buffer is None:
+      logging.info(f"{self.getFileNameForPhoto(photo)} not modified, using {destination}")
+      return Image.open(destination)
+    if destination is None:
+      buffer.seek(0)
+      return Image.open(buffer)
+    buffer.close()
+    return Image.open(destination)
+
+  def cleanup(self):
+    self._run(self.httpSession.close())
+    self.loop.call_soon_threadsafe(self.loop.stop)
+    self.loopThread.join()
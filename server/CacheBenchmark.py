@@ -0,0 +1,75 @@
+# Times adding photos to a full FileCache with 100k entries, against the old
+# approach of sorting every entry by mtime on each overflow. Nothing is written
+# to disk: files are faked by overriding the cache's file operations.
+#
+#   python CacheBenchmark.py --entries 100000 --adds 200
+
+import argparse
+import logging
+import random
+import tempfile
+import time
+
+from FileCache import FileCache
+
+class InMemoryFileCache(FileCache):
+    def _remove_file(self, fullFilePath):
+        pass
+
+    def add(self, file, mtime, size):
+        with self.lock:
+            self._forget(file)
+            self._track(file, mtime, size, push=True)
+            self.ids[file] = file
+            self.fileIds[file] = file
+        self.cleanupCache()
+
+def sortedEviction(photos, sizes, usedSpace, maxSpace):
+    # what cleanupCache used to do on every overflow
+    sortedPhotos = sorted(photos.items(), key = lambda item: item[1])
+    for file, _ in sortedPhotos:
+        if usedSpace <= maxSpace or len(photos) <= 1:
+            break
+        usedSpace -= sizes.pop(file)
+        photos.pop(file)
+    return usedSpace
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=100000)
+    parser.add_argument("--adds", type=int, default=200)
+    parser.add_argument("--size", type=int, default=300 * 1024)
+    args = parser.parse_args()
+
+    maxSpace = args.entries * args.size
+    with tempfile.TemporaryDirectory() as folder:
+        cache = InMemoryFileCache(1, folder)
+        logging.getLogger().setLevel(logging.WARNING)
+        cache.maxAvailableSpace = maxSpace + args.size
+        start = time.perf_counter()
+        for i in range(args.entries):
+            cache.add(f"{i}.JPEG", random.random() * 1000, args.size)
+        print(f"Filled heap cache with {args.entries} entries in {time.perf_counter() - start:.2f}s")
+
+        start = time.perf_counter()
+        for i in range(args.adds):
+            cache.add(f"new{i}.JPEG", 1000 + i, args.size)
+        heapTime = time.perf_counter() - start
+
+    photos = {f"{i}.JPEG": random.random() * 1000 for i in range(args.entries)}
+    sizes = {file: args.size for file in photos}
+    usedSpace = args.entries * args.size
+    start = time.perf_counter()
+    for i in range(args.adds):
+        file = f"new{i}.JPEG"
+        photos[file] = 1000 + i
+        sizes[file] = args.size
+        usedSpace = sortedEviction(photos, sizes, usedSpace + args.size, maxSpace)
+    sortTime = time.perf_counter() - start
+
+    print(f"{'':>8} {'total(s)':>9} {'per add(us)':>12}")
+    print(f"{'heap':>8} {heapTime:9.3f} {heapTime / args.adds * 1e6:12.1f}")
+    print(f"{'sort':>8} {sortTime:9.3f} {sortTime / args.adds * 1e6:12.1f}")
+
+if __name__ == "__main__":
+    main()
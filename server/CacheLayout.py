@@ -0,0 +1,116 @@
+# Where files live inside the working dir and the thumbnail dir. With sharding
+# on, a file goes into one of 256 sub-folders picked from the hash of its name
+# (e.g. ab/IMG_1234.JPEG), which keeps every folder small without creating
+# thousands of them on the SD card. Files are always looked up in every place
+# they could be, including the two-level folders (ab/cd/IMG_1234.JPEG) older
+# versions used, so a cache can be migrated while the frame is running.
+#
+# To move an existing cache into (or out of) the configured layout:
+#
+#   python CacheLayout.py
+
+import hashlib
+import json
+import logging
+import os
+from os import path
+from typing import Iterator, Tuple
+
+from Constants import CONFIG_SHARDED_CACHE, CONFIG_THUMBNAIL_DIR, CONFIG_WORKING_DIR
+
+def _is_shard(name: str) -> bool:
+    return len(name) == 2 and all(c in "0123456789abcdef" for c in name)
+
+class CacheLayout:
+    def __init__(self, root: str, sharded: bool = False) -> None:
+        self.root = root
+        self.sharded = sharded
+
+    def shardPath(self, file: str) -> str:
+        digest = hashlib.md5(file.encode("utf-8")).hexdigest()
+        return path.join(self.root, digest[0:2], file)
+
+    def legacyShardPath(self, file: str) -> str:
+        digest = hashlib.md5(file.encode("utf-8")).hexdigest()
+        return path.join(self.root, digest[0:2], digest[2:4], file)
+
+    def flatPath(self, file: str) -> str:
+        return path.join(self.root, file)
+
+    def pathFor(self, file: str) -> str:
+        # where a new file should be written
+        if not self.sharded:
+            return self.flatPath(file)
+        fullPath = self.shardPath(file)
+        os.makedirs(path.dirname(fullPath), exist_ok=True)
+        return fullPath
+
+    def resolve(self, file: str) -> str:
+        # where an existing file is. Falls back to where it would be written
+        preferred, other = self.flatPath(file), self.shardPath(file)
+        if self.sharded:
+            preferred, other = other, preferred
+        if path.exists(preferred):
+            return preferred
+        for fullPath in [other, self.legacyShardPath(file)]:
+            if path.exists(fullPath):
+                return fullPath
+        return preferred
+
+    def exists(self, file: str) -> bool:
+        return path.exists(self.shardPath(file)) or path.exists(self.flatPath(file)) or path.exists(self.legacyShardPath(file))
+
+    def listFiles(self) -> Iterator[Tuple[str, str]]:
+        # (file name, full path) for every file, in either layout. Other folders
+        # in the root (like a thumbnail folder) are left alone
+        if not path.isdir(self.root):
+            return
+        for entry in os.scandir(self.root):
+            if entry.is_file():
+                yield entry.name, entry.path
+            elif entry.is_dir() and _is_shard(entry.name):
+                for level2 in os.scandir(entry.path):
+                    if level2.is_file():
+                        yield level2.name, level2.path
+                    elif level2.is_dir() and _is_shard(level2.name):
+                        for file in os.scandir(level2.path):
+                            if file.is_file():
+                                yield file.name, file.path
+
+    def migrate(self) -> int:
+        # move every file that isn't where the layout wants it. Renames are
+        # atomic, so readers always find the file in one place or the other
+        moved = 0
+        for file, fullPath in list(self.listFiles()):
+            target = self.pathFor(file)
+            if fullPath != target:
+                os.rename(fullPath, target)
+                moved += 1
+        # and drop the second level folders emptied by moving out of the old layout
+        for entry in os.scandir(self.root):
+            if entry.is_dir() and _is_shard(entry.name):
+                for level2 in os.scandir(entry.path):
+                    if level2.is_dir() and _is_shard(level2.name):
+                        try:
+                            os.rmdir(level2.path)
+                        except OSError:
+                            pass
+            if entry.is_dir() and _is_shard(entry.name) and not self.sharded:
+                try:
+                    os.rmdir(entry.path)
+                except OSError:
+                    pass
+        logging.info(f"Moved {moved} files in {self.root}")
+        return moved
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(message)s')
+    configPath = path.join(path.dirname(path.realpath(__file__)), "../config.json")
+    with open(configPath, 'r') as config:
+        config = json.load(config)
+    sharded = CONFIG_SHARDED_CACHE in config and config[CONFIG_SHARDED_CACHE]
+    for root in [config[CONFIG_WORKING_DIR], path.join(config[CONFIG_WORKING_DIR], "frames"), config[CONFIG_THUMBNAIL_DIR]]:
+        CacheLayout(root, sharded).migrate()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import logging
+import os
+from os import path
+from threading import Thread
+from typing import Callable
+
+from inotify_simple import INotify, flags
+
+from CacheLayout import _is_shard
+from FileCache import FileCache
+
+class CacheWatcher:
+    # Keeps a FileCache in step with its working dir through inotify (Linux only),
+    # so files written, moved or deleted by anything else (kept originals, manual
+    # cleanup, a layout migration) are accounted for as they happen instead of on
+    # the next full scan. Changes reach subscribers through the cache's events.
+    # Files for which isBusy is true are still being written by the collector,
+    # which adds them to the cache itself once they're done.
+    fileMask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.DELETE | flags.MOVED_FROM
+    dirMask = flags.CREATE | flags.DELETE_SELF
+
+    def __init__(self, cache: FileCache, isBusy: Callable[[str], bool] = None) -> None:
+        self.cache = cache
+        self.isBusy = isBusy
+        self.finished = False
+        self.inotify = INotify()
+        # watch descriptor -> (folder, depth below the working dir)
+        self.folders = dict()
+        self._watch(cache.workingDir, 0, False)
+        logging.info(f'Watching {len(self.folders)} folders under {cache.workingDir}')
+        self.thread = Thread(target=self._run, name="cache-watcher", daemon=True)
+        self.thread.start()
+
+    def _watch(self, folder, depth, sync):
+        # watch a folder and the shard folders under it, down to the second level
+        # older layouts used. With sync the files found are handed to the cache
+        # too, in case they landed before the watch did
+        try:
+            wd = self.inotify.add_watch(folder, self.fileMask | self.dirMask)
+        except OSError as e:
+            logging.error(f'Unable to watch {folder}: {e}')
+            return
+        self.folders[wd] = (folder, depth)
+        for entry in os.scandir(folder):
+            if entry.is_dir() and depth < 2 and _is_shard(entry.name):
+                self._watch(entry.path, depth + 1, sync)
+            elif sync and entry.is_file():
+                self._sync(entry.name, entry.path)
+
+    def _sync(self, file, fullPath):
+        if self.isBusy is not None and self.isBusy(file):
+            return
+        self.cache.syncFile(file, fullPath)
+
+    def _run(self):
+        while not self.finished:
+            for event in self.inotify.read(timeout=1000):
+                try:
+                    self._handle(event)
+                except Exception as e:
+                    logging.error(f'Cache watcher failed on {event}: {e}')
+
+    def _handle(self, event):
+        mask = flags.from_mask(event.mask)
+        if flags.Q_OVERFLOW in mask:
+            # the kernel dropped events, only a full scan can tell what we missed
+            logging.error('Cache watcher overflowed, reconciling')
+            self.cache.reconcile()
+            return
+        if flags.IGNORED in mask:
+            self.folders.pop(event.wd, None)
+            return
+        if event.wd not in self.folders:
+            return
+        folder, depth = self.folders[event.wd]
+        if flags.ISDIR in mask:
+            if flags.CREATE in mask and depth < 2 and _is_shard(event.name):
+                self._watch(path.join(folder, event.name), depth + 1, True)
+            return
+        if flags.DELETE_SELF in mask:
+            return
+        if flags.CLOSE_WRITE in mask or flags.MOVED_TO in mask:
+            self._sync(event.name, path.join(folder, event.name))
+        elif flags.DELETE in mask or flags.MOVED_FROM in mask:
+            self.cache.syncRemoved(event.name)
+
+    def cleanup(self):
+        self.finished = True
+        self.thread.join()
+        self.inotify.close()
@@ -1,4 +1,6 @@
 STATUS_CHANGED_EVENT = 'status_changed'
+PHOTO_ADDED_EVENT = 'photo_added'
+PHOTO_REMOVED_EVENT = 'photo_removed'
 CONFIG_LOG_TO_FILE = 'logToFile'
 CONFIG_SERVER_SOCKET = 'serverSocket'
 CONFIG_WORKING_DIR = 'workingDir'
@@ -10,4 +12,25 @@ CONFIG_IPC_SOCKET = 'ipcSocket'
 CONFIG_STATUS_SOCKET = 'loggingSocket'
 CONFIG_KEEP_ORIGINAL_FILES = 'keepOriginalFiles'
 CONFIG_IMMICH_SERVER_URL = 'immichServerUrl'
-CONFIG_RECENCY_BIAS = 'recencyBias'
\ No newline at end of file
+CONFIG_RECENCY_BIAS = 'recencyBias'
+CONFIG_PIPELINE_WORKERS = 'pipelineWorkers'
+CONFIG_PIPELINE_QUEUE_SIZE = 'pipelineQueueSize'
+CONFIG_FACE_DETECTION_WORKERS = 'faceDetectionWorkers'
+CONFIG_FACE_DETECTION_TIMEOUT = 'faceDetectionTimeout'
+CONFIG_FACE_DETECTION_MAX_EDGE = 'faceDetectionMaxEdge'
+CONFIG_DATA_DIR = 'dataDir'
+CONFIG_MAX_REQUEST_RATE = 'maxRequestRate'
+CONFIG_IN_MEMORY_DOWNLOADS = 'inMemoryDownloads'
+CONFIG_SPOOL_THRESHOLD_MB = 'spoolThresholdMb'
+CONFIG_REQUEST_TIMEOUT = 'requestTimeout'
+CONFIG_REQUEST_RETRIES = 'requestRetries'
+CONFIG_ASYNC_CLIENT = 'asyncClient'
+CONFIG_CONCURRENT_REQUESTS = 'concurrentRequests'
+CONFIG_RENDITION_SIZES = 'renditionSizes'
+CONFIG_NEAR_DUPLICATE_THRESHOLD = 'nearDuplicateThreshold'
+CONFIG_CACHE_LOW_WATERMARK = 'cacheLowWatermark'
+CONFIG_SHARDED_CACHE = 'shardedCache'
+CONFIG_EVICTION_POLICY = 'evictionPolicy'
+CONFIG_WATCH_CACHE = 'watchCache'
+CONFIG_RAW_FRAMES = 'rawFrames'
+CONFIG_RAW_FRAMES_MB = 'rawFramesMb'
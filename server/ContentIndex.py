@@ -0,0 +1,56 @@
+import logging
+import sqlite3
+from threading import Lock
+
+class ContentIndex:
+    # Maps asset checksums to the rendered file in the working dir, so the same
+    # picture uploaded twice is only downloaded and processed once. Also remembers
+    # the ETag of every download, for conditional requests.
+    def __init__(self, dbPath: str) -> None:
+        self.lock = Lock()
+        self.db = sqlite3.connect(dbPath, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS content (
+                checksum TEXT PRIMARY KEY,
+                fileName TEXT);
+            CREATE TABLE IF NOT EXISTS etags (
+                url TEXT PRIMARY KEY,
+                etag TEXT);
+            """)
+        self.db.commit()
+        logging.info(f"Content index at {dbPath}")
+
+    def lookup(self, checksum: str) -> str:
+        if not checksum:
+            return None
+        with self.lock:
+            row = self.db.execute("SELECT fileName FROM content WHERE checksum = ?", (checksum,)).fetchone()
+        return row[0] if row else None
+
+    def add(self, checksum: str, fileName: str):
+        if not checksum:
+            return
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO content (checksum, fileName) VALUES (?, ?)", (checksum, fileName))
+            self.db.commit()
+
+    def remove(self, checksum: str):
+        with self.lock:
+            self.db.execute("DELETE FROM content WHERE checksum = ?", (checksum,))
+            self.db.commit()
+
+    def getETag(self, url: str) -> str:
+        with self.lock:
+            row = self.db.execute("SELECT etag FROM etags WHERE url = ?", (url,)).fetchone()
+        return row[0] if row else None
+
+    def setETag(self, url: str, etag: str):
+        if not etag:
+            return
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO etags (url, etag) VALUES (?, ?)", (url, etag))
+            self.db.commit()
+
+    def cleanup(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,63 @@
+# Measures decode + resize time and peak memory for JPEGs of different sizes,
+# with a full decode and with a reduced-scale (draft) decode. Every case runs in
+# its own process so the peak RSS numbers don't bleed into each other.
+#
+#   python DecodeBenchmark.py --screenSize 800 480
+
+import argparse
+import multiprocessing
+import resource
+import tempfile
+import time
+from os import path
+
+from PIL import Image
+
+sourceSizes = [(1600, 1200), (2592, 1944), (3264, 2448), (4032, 3024), (4608, 3456)]
+
+def fillSize(size, screenSize):
+    if size[0] / size[1] > screenSize[0] / screenSize[1]:
+        percent = screenSize[1] / size[1]
+    else:
+        percent = screenSize[0] / size[0]
+    return (int(size[0] * percent), int(size[1] * percent))
+
+def decode(file, screenSize, useDraft, repeat, results):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        image = Image.open(file)
+        targetSize = fillSize(image.size, screenSize)
+        if useDraft:
+            image.draft(image.mode, targetSize)
+        image.load()
+        image = image.resize(targetSize)
+    elapsed = (time.perf_counter() - start) / repeat
+    # ru_maxrss is in kilobytes on Linux
+    results.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+def measure(file, screenSize, useDraft, repeat):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=decode, args=(file, screenSize, useDraft, repeat, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--screenSize", type=int, nargs=2, default=[800, 480])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'source':>10} {'full(ms)':>9} {'full(MB)':>9} {'draft(ms)':>10} {'draft(MB)':>10}")
+    with tempfile.TemporaryDirectory() as folder:
+        for size in sourceSizes:
+            file = path.join(folder, f"{size[0]}x{size[1]}.jpg")
+            Image.effect_noise(size, 64).convert("RGB").save(file, "JPEG", quality=90)
+            fullTime, fullRss = measure(file, args.screenSize, False, args.repeat)
+            draftTime, draftRss = measure(file, args.screenSize, True, args.repeat)
+            print(f"{size[0]}x{size[1]:<5} {fullTime * 1000:9.1f} {fullRss:9.1f} {draftTime * 1000:10.1f} {draftRss:10.1f}")
+
+if __name__ == "__main__":
+    main()
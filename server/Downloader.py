@@ -1,10 +1,12 @@
 import enum
+import logging
 from typing import Dict, List
 
 from pyee import BaseEventEmitter
 from PIL import Image
 
 from Constants import STATUS_CHANGED_EVENT
+from RateLimiter import RateLimiter
 
 class Status(enum.Enum):
     NotLoggedIn = 1
@@ -19,7 +21,8 @@ class Photo:
         self.image = None
         self._status = Status.NotLoggedIn
 
-    def download(self, destination):
+    def download(self, destination = None):
+        # with no destination the downloader keeps the photo in memory
         if not self.image:
             self.image = self.downloader.downloadPhoto(self.photo, destination)
         return self.image
@@ -40,17 +43,46 @@ class Photo:
     def created(self):
         return self.downloader.getCreatedDateForPhoto(self.photo)
 
+    @property
+    def checksum(self) -> str:
+        return self.downloader.getChecksumForPhoto(self.photo)
+
+    @property
+    def type(self) -> str:
+        return self.downloader.getTypeForPhoto(self.photo)
+
 class Downloader(BaseEventEmitter):
     _status = Status.NotLoggedIn
+    rateLimiter: RateLimiter = None
+    # True if listing every bucket up front is cheap enough to do at startup
+    concurrentListing: bool = False
+    # set by the PhotoProcessor so downloaders can pick a suitable size to fetch
+    screenSize = [0, 0]
+    # set by the PhotoProcessor; remembers ETags for conditional downloads
+    contentIndex = None
     
-    def __init__(self):
+    def __init__(self, maxRequestRate: float = 20.0):
         super().__init__()
+        # shared by every request this downloader makes
+        self.rateLimiter = RateLimiter(maxRate=maxRequestRate)
 
     def getTimelineBuckets(self) -> List[Dict[str, object]]:
         raise NotImplementedError
+    def getPhotosForBucket(self, bucketName: str) -> List[Photo]:
+        raise NotImplementedError
+    def getPhotosForBuckets(self, bucketNames: List[str]) -> Dict[str, List[Photo]]:
+        # downloaders that can list buckets concurrently override this. Buckets that
+        # fail to list are left out of the result
+        result = dict()
+        for bucketName in bucketNames:
+            try:
+                result[bucketName] = self.getPhotosForBucket(bucketName)
+            except Exception as e:
+                logging.error(f"Could not list bucket {bucketName}: {e}")
+        return result
     def getPhotosList(self) -> List[Photo]:
         raise NotImplementedError
-    def downloadPhoto(self, photo, destination) -> Image:
+    def downloadPhoto(self, photo, destination = None) -> Image:
         raise NotImplementedError
     def authenticate(self, userName, password):
         raise NotImplementedError
@@ -62,11 +94,22 @@ class Downloader(BaseEventEmitter):
         raise NotImplementedError
     def getCreatedDateForPhoto(self, photo):
         raise NotImplementedError
+    def getChecksumForPhoto(self, photo):
+        raise NotImplementedError
+    def getTypeForPhoto(self, photo):
+        raise NotImplementedError
     
+    def cleanup(self):
+        pass
+
     @property
     def numPhotosInAlbum(self):
         raise NotImplementedError
     
+    @property
+    def requestRate(self) -> float:
+        return self.rateLimiter.rate
+
     @property
     def status(self):
         return self._status
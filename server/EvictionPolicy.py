@@ -0,0 +1,145 @@
+import heapq
+from collections import OrderedDict
+from typing import Iterable, Tuple
+
+class EvictionPolicy:
+    # Decides which cached file FileCache deletes next. The cache tells the policy
+    # about files coming and going, and about every time a file is shown on the
+    # frame, and asks it for a victim when it needs space. Callers hold the
+    # cache's lock, so policies don't lock themselves.
+    def load(self, entries: Iterable[Tuple[str, float, int, float]]):
+        # (file, mtime, hits, lastShown) for everything already in the cache,
+        # added oldest first
+        for file, mtime, hits, lastShown in sorted(entries, key=lambda entry: max(entry[1], entry[3])):
+            self.add(file, mtime, hits, lastShown)
+
+    def add(self, file: str, mtime: float, hits: int = 0, lastShown: float = 0):
+        raise NotImplementedError
+
+    def remove(self, file: str):
+        raise NotImplementedError
+
+    def touch(self, file: str, hits: int, lastShown: float):
+        raise NotImplementedError
+
+    def victim(self) -> str:
+        # the file to evict next, which is forgotten by the policy. None if empty
+        raise NotImplementedError
+
+class HeapPolicy(EvictionPolicy):
+    # evicts the file with the smallest key. The heap may hold stale entries for
+    # files that were removed or whose key changed; they're skipped when popped
+    def __init__(self) -> None:
+        self.keys = dict()
+        self.heap = []
+
+    def key(self, mtime: float, hits: int, lastShown: float):
+        raise NotImplementedError
+
+    def add(self, file: str, mtime: float, hits: int = 0, lastShown: float = 0):
+        self._set(file, (mtime, self.key(mtime, hits, lastShown)))
+
+    def remove(self, file: str):
+        self.keys.pop(file, None)
+
+    def touch(self, file: str, hits: int, lastShown: float):
+        if file in self.keys:
+            mtime = self.keys[file][0]
+            self._set(file, (mtime, self.key(mtime, hits, lastShown)))
+
+    def victim(self) -> str:
+        while len(self.heap) > 0:
+            key, file = heapq.heappop(self.heap)
+            if file in self.keys and self.keys[file][1] == key:
+                self.keys.pop(file)
+                return file
+        return None
+
+    def _set(self, file, entry):
+        self.keys[file] = entry
+        if len(self.heap) > 2 * len(self.keys) + 1000:
+            # too many stale entries, rebuild from the live ones
+            self.heap = [(key, file) for file, (mtime, key) in self.keys.items()]
+            heapq.heapify(self.heap)
+        else:
+            heapq.heappush(self.heap, (entry[1], file))
+
+class LRUPolicy(HeapPolicy):
+    # evicts whatever was downloaded or shown least recently
+    def key(self, mtime, hits, lastShown):
+        return max(mtime, lastShown)
+
+class LFUPolicy(HeapPolicy):
+    # evicts whatever has been shown the fewest times, oldest first among equals
+    def key(self, mtime, hits, lastShown):
+        return (hits, max(mtime, lastShown))
+
+class ARCPolicy(EvictionPolicy):
+    # Adaptive replacement cache. t1 holds files shown at most once, t2 files shown
+    # more often; b1 and b2 remember what was recently evicted from each. A file
+    # that comes back after being evicted tells us which list we shrank too far,
+    # and p (the share of the cache t1 gets) moves towards it.
+    def __init__(self) -> None:
+        self.t1 = OrderedDict()
+        self.t2 = OrderedDict()
+        self.b1 = OrderedDict()
+        self.b2 = OrderedDict()
+        self.p = 0.0
+
+    @property
+    def capacity(self) -> int:
+        return max(1, len(self.t1) + len(self.t2))
+
+    def add(self, file: str, mtime: float, hits: int = 0, lastShown: float = 0):
+        self.remove(file)
+        if file in self.b1:
+            self.p = min(self.capacity, self.p + max(len(self.b2) / len(self.b1), 1))
+            self.b1.pop(file)
+            self.t2[file] = True
+        elif file in self.b2:
+            self.p = max(0.0, self.p - max(len(self.b1) / len(self.b2), 1))
+            self.b2.pop(file)
+            self.t2[file] = True
+        elif hits > 1:
+            self.t2[file] = True
+        else:
+            self.t1[file] = True
+
+    def remove(self, file: str):
+        self.t1.pop(file, None)
+        self.t2.pop(file, None)
+
+    def touch(self, file: str, hits: int, lastShown: float):
+        # the same rule as add, so a restart puts every file back where it was
+        if file in self.t1 and hits > 1:
+            self.t1.pop(file)
+            self.t2[file] = True
+        elif file in self.t1:
+            self.t1.move_to_end(file)
+        elif file in self.t2:
+            self.t2.move_to_end(file)
+
+    def victim(self) -> str:
+        if len(self.t1) > 0 and (len(self.t1) > self.p or len(self.t2) == 0):
+            file, _ = self.t1.popitem(last=False)
+            self.b1[file] = True
+        elif len(self.t2) > 0:
+            file, _ = self.t2.popitem(last=False)
+            self.b2[file] = True
+        else:
+            return None
+        # the ghost lists only need to remember about a cache's worth of files
+        while len(self.b1) > self.capacity:
+            self.b1.popitem(last=False)
+        while len(self.b2) > self.capacity:
+            self.b2.popitem(last=False)
+        return file
+
+policies = {
+    "lru": LRUPolicy,
+    "lfu": LFUPolicy,
+    "arc": ARCPolicy
+}
+
+def createEvictionPolicy(name: str) -> EvictionPolicy:
+    return policies[name.lower()]()
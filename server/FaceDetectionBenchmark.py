@@ -0,0 +1,69 @@
+# Compares full size face detection against proxy detection on a folder of
+# fixture images. For every proxy size it reports the detection time and how
+# well the faces bounding box (which is what drives the crop) agrees with the
+# full size one.
+#
+#   python FaceDetectionBenchmark.py ~/fixtures --maxEdge 320 480 640
+
+import argparse
+import glob
+import time
+from os import path
+
+from PIL import Image
+
+from FaceDetector import FaceDetector
+
+def boundingRect(locations):
+    if len(locations) == 0:
+        return None
+    return (min(l[3] for l in locations), min(l[0] for l in locations),
+            max(l[1] for l in locations), max(l[2] for l in locations))
+
+def overlap(a, b) -> float:
+    # intersection over union of two (left, top, right, bottom) boxes
+    if a is None or b is None:
+        return 1.0 if a == b else 0.0
+    width = min(a[2], b[2]) - max(a[0], b[0])
+    height = min(a[3], b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return intersection / union
+
+def run(detector: FaceDetector, images):
+    results = []
+    start = time.perf_counter()
+    for image in images:
+        results.append(detector.findFaces(image))
+    return time.perf_counter() - start, results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("fixtures", help="folder of JPEG images")
+    parser.add_argument("--maxEdge", type=int, nargs="+", default=[320, 480, 640, 800])
+    parser.add_argument("--screenSize", type=int, nargs=2, default=[1920, 1080])
+    args = parser.parse_args()
+
+    files = sorted(glob.glob(path.join(args.fixtures, "*.jp*g")) + glob.glob(path.join(args.fixtures, "*.JP*G")))
+    images = []
+    for file in files:
+        image = Image.open(file)
+        # detection runs on the screen sized image, so benchmark on that too
+        image.thumbnail(args.screenSize)
+        images.append(image.convert("RGB"))
+    print(f"{len(images)} fixture images")
+
+    baselineTime, baseline = run(FaceDetector(), images)
+    print(f"{'maxEdge':>8} {'time(s)':>8} {'speedup':>8} {'same #faces':>12} {'mean IoU':>9}")
+    print(f"{'full':>8} {baselineTime:8.2f} {1.0:8.2f} {100.0:11.1f}% {1.0:9.3f}")
+
+    for maxEdge in args.maxEdge:
+        elapsed, results = run(FaceDetector(maxEdge=maxEdge), images)
+        sameCount = sum(1 for a, b in zip(baseline, results) if len(a) == len(b))
+        meanOverlap = sum(overlap(boundingRect(a), boundingRect(b)) for a, b in zip(baseline, results)) / max(1, len(images))
+        print(f"{maxEdge:>8} {elapsed:8.2f} {baselineTime / max(elapsed, 1e-9):8.2f} {100.0 * sameCount / max(1, len(images)):11.1f}% {meanOverlap:9.3f}")
+
+if __name__ == "__main__":
+    main()
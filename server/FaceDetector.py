@@ -0,0 +1,120 @@
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+from threading import Lock
+from time import monotonic
+from typing import List, Tuple
+
+import face_recognition
+import numpy as np
+from PIL import Image
+
+def _detect_faces(shmName: str, shape) -> List[Tuple[int, int, int, int]]:
+    # runs in a pool process. Attach to the pixels the parent put in shared memory
+    # instead of having them pickled across
+    shm = shared_memory.SharedMemory(name=shmName)
+    try:
+        pixels = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        locations = face_recognition.face_locations(pixels)
+        del pixels
+        return [tuple(location) for location in locations]
+    finally:
+        shm.close()
+
+class FaceDetectionTimeout(Exception):
+    # detection didn't finish, which says nothing about whether there are faces
+    pass
+
+class FaceDetector:
+    # Finds face locations in a PIL image, as (top, right, bottom, left) tuples.
+    # With numWorkers > 0 detection runs in a pool of processes so it isn't bound
+    # to the GIL; with 0 it runs on the calling thread like it always has.
+    # With maxEdge > 0 detection runs on a proxy image whose longest edge is at
+    # most maxEdge pixels, and the boxes are scaled back to the full image. Smaller
+    # is faster but misses small faces.
+    numWorkers: int = 0
+    timeout: float = 60
+    maxEdge: int = 0
+    pool = None
+
+    def __init__(self, numWorkers: int = 0, timeout: float = 60, maxEdge: int = 0) -> None:
+        self.numWorkers = numWorkers
+        self.timeout = timeout
+        self.maxEdge = maxEdge
+        self.poolLock = Lock()
+        if self.numWorkers > 0:
+            self.pool = self._create_pool()
+
+    def findFaces(self, image: Image) -> List[Tuple[int, int, int, int]]:
+        scale = 1.0
+        fullSize = image.size
+        longestEdge = max(image.size)
+        if self.maxEdge > 0 and longestEdge > self.maxEdge:
+            scale = self.maxEdge / longestEdge
+            proxySize = (max(1, round(image.size[0] * scale)), max(1, round(image.size[1] * scale)))
+            image = image.resize(proxySize, Image.BILINEAR)
+
+        locations = self._find_faces(image)
+        if scale == 1.0:
+            return locations
+        return [self._scale_location(location, scale, fullSize) for location in locations]
+
+    def _scale_location(self, location, scale: float, fullSize) -> Tuple[int, int, int, int]:
+        top, right, bottom, left = location
+        return (max(0, round(top / scale)),
+                min(fullSize[0], round(right / scale)),
+                min(fullSize[1], round(bottom / scale)),
+                max(0, round(left / scale)))
+
+    def _find_faces(self, image: Image) -> List[Tuple[int, int, int, int]]:
+        im = image.convert('RGB')
+        if self.pool is None:
+            return face_recognition.face_locations(np.array(im))
+
+        pixels = np.asarray(im)
+        shm = shared_memory.SharedMemory(create=True, size=pixels.nbytes)
+        try:
+            shared = np.ndarray(pixels.shape, dtype=np.uint8, buffer=shm.buf)
+            shared[:] = pixels
+            del shared
+            with self.poolLock:
+                pool = self.pool
+                pending = pool.apply_async(_detect_faces, (shm.name, pixels.shape))
+            deadline = monotonic() + self.timeout
+            while not pending.ready():
+                if self.pool is not pool:
+                    # another job timed out and took the pool this one was on with it
+                    raise FaceDetectionTimeout("Face detection pool was restarted")
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    # the worker is stuck on this image. There's no way to cancel a single
+                    # job, so throw the pool away and start a fresh one
+                    logging.error(f"Face detection timed out after {self.timeout}s, restarting detection pool")
+                    self._restart_pool(pool)
+                    raise FaceDetectionTimeout(f"Face detection timed out after {self.timeout}s")
+                pending.wait(min(remaining, 0.5))
+            return pending.get()
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def _create_pool(self):
+        logging.info(f"Starting face detection pool with {self.numWorkers} process(es)")
+        # spawn rather than fork: the collector has zmq and pipeline threads running
+        return multiprocessing.get_context("spawn").Pool(self.numWorkers)
+
+    def _restart_pool(self, pool):
+        with self.poolLock:
+            if self.pool is not pool:
+                # another job already replaced it
+                return
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = self._create_pool()
+
+    def cleanup(self):
+        with self.poolLock:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool.join()
+                self.pool = None
@@ -1,18 +1,41 @@
 import shutil
 import os
+import json
+import sqlite3
 from os import path
+from pyee import BaseEventEmitter
 import logging
+import time
+from threading import RLock, Thread
 
+from Constants import PHOTO_ADDED_EVENT, PHOTO_REMOVED_EVENT
 from Downloader import Photo
+from CacheLayout import CacheLayout
+from EvictionPolicy import createEvictionPolicy
 
-class FileCache:
+# display counts are written to the manifest after this many photos have been
+# shown, or this long after the last write
+DISPLAY_SAVE_COUNT = 50
+DISPLAY_SAVE_SECS = 300
+
+def _inode(stat):
+    # identifies the file's data on disk, in the form the manifest stores it
+    return f'{stat.st_dev}:{stat.st_ino}'
+
+class FileCache(BaseEventEmitter):
+    # emits PHOTO_ADDED_EVENT and PHOTO_REMOVED_EVENT with the file name whenever
+    # a file starts or stops being tracked, once the lock has been released
     maxAvailableSpace = 0
     photos = dict()
     workingDir = "/tmp/photos"
     usedSpace = 0
     finished = False
+    # once we go over maxAvailableSpace, evict down to this fraction of it, so we
+    # don't end up evicting on every single photo we add
+    lowWatermark = 0.95
 
-    def __init__(self, maxSpace, workingDir) -> None:
+    def __init__(self, maxSpace, workingDir, lowWatermark = None, manifestPath = None, sharded = False, evictionPolicy = "lru") -> None:
+        super().__init__()
         logging.getLogger().setLevel(logging.INFO)
         total, used, free = shutil.disk_usage("/")
         self.maxAvailableSpace = min(free - (1<<30), maxSpace * (1<<30))
@@ -20,37 +43,157 @@ class FileCache:
 
         if workingDir:
             self.workingDir = workingDir
+        if lowWatermark is not None:
+            self.lowWatermark = lowWatermark
 
         checkfolder = path.isdir(self.workingDir)
         if not checkfolder:
             os.makedirs(self.workingDir)
+        # every path into the working dir goes through the layout
+        self.layout = CacheLayout(self.workingDir, sharded)
 
-        # initialize the photos dict
-        self.loadPhotos()
-        self.cleanupCache()
+        # photos maps file name -> mtime, sizes maps file name -> bytes, and ids
+        # maps asset ids to the file name they were saved under. displays maps file
+        # name -> (times shown, last shown) as reported by the slideshow, and the
+        # policy picks what to evict from all of that
+        self.photos = dict()
+        self.sizes = dict()
+        # a duplicate is hard linked to the copy we already have (see
+        # PhotoProcessor._link_duplicate), so usedSpace counts each inode once:
+        # inodes maps (device, inode) -> the files linked to it, fileInodes is the
+        # reverse and charges holds what each file added to usedSpace
+        self.inodes = dict()
+        self.fileInodes = dict()
+        self.charges = dict()
+        self.ids = dict()
+        self.fileIds = dict()
+        self.displays = dict()
+        # display counts not yet written to the manifest, flushed in batches so
+        # the SD card isn't written to on every slide
+        self.unsavedDisplays = set()
+        self.displaysSavedAt = time.monotonic()
+        self.policy = createEvictionPolicy(evictionPolicy)
+        logging.info(f'File Cache evicts with {type(self.policy).__name__}')
+        self.usedSpace = 0
+        self.lock = RLock()
+        self.manifest = None
+        self.reconcileThread = None
 
-    def deletePhoto(self, photo: Photo):
-        fullFilePath = self.workingDir + "/" + photo.id
-        self.usedSpace -= path.getsize(fullFilePath)
-        logging.info(f'Deleting {fullFilePath}')
-        os.unlink(fullFilePath)
-        self.photos.pop(photo)
+        # initialize the photos dict. With a manifest that's a single read, and the
+        # directory gets checked against it in the background
+        if manifestPath:
+            self.manifest = self._open_manifest(manifestPath)
+            self.loadManifest()
+            self.reconcileThread = Thread(target=self.reconcile, name="cache-reconcile", daemon=True)
+            self.reconcileThread.start()
+        else:
+            self.loadPhotos()
         self.cleanupCache()
 
+    def deletePhoto(self, file: str):
+        with self.lock:
+            fullFilePath = self.layout.resolve(file)
+            logging.info(f'Deleting {fullFilePath}')
+            try:
+                self._remove_file(fullFilePath)
+            except FileNotFoundError:
+                # removed behind our back, it only needs forgetting
+                logging.warning(f'{fullFilePath} was already gone')
+            self._forget(file)
+            if self.manifest is not None:
+                self.manifest.commit()
+        self.emit(PHOTO_REMOVED_EVENT, file)
+
     def loadPhotos(self):
-        for file in os.listdir(self.workingDir):
-            fullFilePath = os.path.join(self.workingDir, file)
-            if path.isfile(fullFilePath):
-                self.photos[file] = os.path.getmtime(fullFilePath)
-                self.usedSpace += path.getsize(fullFilePath)
+        for file, fullFilePath in self.layout.listFiles():
+            stat = os.stat(fullFilePath)
+            self._track(file, stat.st_mtime, stat.st_size, inode=_inode(stat))
+        self._load_policy()
+
+    def loadManifest(self):
+        with self.lock:
+            rows = self.manifest.execute("SELECT file, id, size, mtime, hits, lastShown, inode FROM files").fetchall()
+            for file, id, size, mtime, hits, lastShown, inode in rows:
+                self._track(file, mtime, size, inode=inode)
+                if id is not None:
+                    self.ids[id] = file
+                    self.fileIds[file] = id
+                if hits:
+                    self.displays[file] = (hits, lastShown)
+            self._load_policy()
+        logging.info(f'Loaded {len(rows)} photos from the cache manifest')
+
+    def reconcile(self):
+        # bring the manifest back in line with what's actually on disk, e.g. after
+        # a crash or files being removed by hand
+        onDisk = set()
+        added = []
+        removed = []
+        for file, fullFilePath in self.layout.listFiles():
+            onDisk.add(file)
+            stat = os.stat(fullFilePath)
+            with self.lock:
+                # manifests from before inodes were kept get them filled in here
+                if self.photos.get(file) != stat.st_mtime or self.sizes.get(file) != stat.st_size or self.fileInodes.get(file) != _inode(stat):
+                    self._forget(file, keepId=True)
+                    self._track(file, stat.st_mtime, stat.st_size, push=True, inode=_inode(stat))
+                    self._write_manifest(file, self.fileIds.get(file), stat.st_size, stat.st_mtime, inode=_inode(stat))
+                    added.append(file)
+        with self.lock:
+            for file in [file for file in self.photos if file not in onDisk]:
+                if self.layout.exists(file):
+                    # added while we were listing
+                    continue
+                self._forget(file)
+                removed.append(file)
+            if self.manifest is not None:
+                self.manifest.commit()
+        logging.info(f'Cache manifest reconciled: {len(added)} added or updated, {len(removed)} removed')
+        for file in added:
+            self.emit(PHOTO_ADDED_EVENT, file)
+        for file in removed:
+            self.emit(PHOTO_REMOVED_EVENT, file)
+        self.cleanupCache()
+
+    def syncFile(self, file, fullFilePath):
+        # a file was written or moved into the working dir behind our back (or by
+        # us, in which case it's already tracked and nothing changes)
+        try:
+            stat = os.stat(fullFilePath)
+        except FileNotFoundError:
+            return
+        with self.lock:
+            if self.photos.get(file) == stat.st_mtime and self.sizes.get(file) == stat.st_size and self.fileInodes.get(file) == _inode(stat):
+                return
+            self._forget(file, keepId=True)
+            self._track(file, stat.st_mtime, stat.st_size, push=True, inode=_inode(stat))
+            self._write_manifest(file, self.fileIds.get(file), stat.st_size, stat.st_mtime, inode=_inode(stat))
+            if self.manifest is not None:
+                self.manifest.commit()
+        self.emit(PHOTO_ADDED_EVENT, file)
+        self.cleanupCache()
+
+    def syncRemoved(self, file):
+        # a file was deleted or moved out of the working dir. Moves between the flat
+        # and sharded layouts show up as a removal followed by an add, so check it's
+        # really gone
+        with self.lock:
+            if file not in self.photos or self.layout.exists(file):
+                return
+            self._forget(file)
+            if self.manifest is not None:
+                self.manifest.commit()
+        self.emit(PHOTO_REMOVED_EVENT, file)
 
     def isPhotoInCache(self, file):
-        return file in self.photos.keys()
+        if isinstance(file, Photo):
+            return file.id in self.ids
+        return file in self.photos or file in self.ids
 
     @property
     def numFiles(self):
         return len(self.photos.keys())
-        
+
     @property
     def cacheUsePercent(self):
         if self.maxAvailableSpace > 0:
@@ -60,35 +203,187 @@ class FileCache:
             result = 100
         return result
 
-    def addPhotoToCache(self, photo, fullPath):
-        self.photos[photo.id] = os.path.getmtime(fullPath)
-        self.usedSpace += path.getsize(fullPath)
-        logging.info(f'Added {photo.id} to cache')
+    def addPhotoToCache(self, photo, fullPath, metadata = None):
+        file = path.basename(fullPath)
+        with self.lock:
+            self._forget(file)
+            stat = os.stat(fullPath)
+            self._track(file, stat.st_mtime, stat.st_size, push=True, inode=_inode(stat))
+            self.ids[photo.id] = file
+            self.fileIds[file] = photo.id
+            self._write_manifest(file, photo.id, stat.st_size, stat.st_mtime, photo.checksum, metadata, _inode(stat))
+            if self.manifest is not None:
+                self.manifest.commit()
+        logging.info(f'Added {photo.id} to cache as {file}')
+        self.emit(PHOTO_ADDED_EVENT, file)
         self.cleanupCache()
 
     def cleanupCache(self):
-        if self.maxAvailableSpace <= self.usedSpace:
-            logging.info(f'Cleaning up {(self.usedSpace - self.maxAvailableSpace)/(1 << 10)}(kb) of space', )
-            # sort dictionary by timestamp, and 
-            # start removing oldest
-            sortedPhotos = sorted(self.photos.items(), key = lambda item: item[1])
-
-            # now start removing until we are good or we have only one photo left
-            retry = 0
-            while len(self.photos.keys()) > 1 and self.maxAvailableSpace < self.usedSpace and retry < 10:
+        evicted = []
+        with self.lock:
+            if self.maxAvailableSpace > self.usedSpace:
+                return
+            target = self.maxAvailableSpace * self.lowWatermark
+            logging.info(f'Cleaning up {(self.usedSpace - target)/(1 << 10)}(kb) of space', )
+
+            # evict whatever the policy picks until we're under the low watermark,
+            # or we have only one photo left
+            skipped = []
+            while len(self.photos) > 1 and self.usedSpace > target:
+                file = self.policy.victim()
+                if file is None:
+                    break
+                if file not in self.photos:
+                    continue
+                fullFilePath = self.layout.resolve(file)
                 try:
-                    file = sortedPhotos[0][0]
-                    fullFilePath = self.workingDir + "/" + file
-                    self.usedSpace -= path.getsize(fullFilePath)
                     logging.info(f'Cleanup deleting {fullFilePath}')
-                    os.unlink(fullFilePath)
-                    self.photos.pop(file)
+                    self._remove_file(fullFilePath)
                 except FileNotFoundError:
-                    retry = retry + 1
                     logging.error(f'Unable to delete {fullFilePath}: not found')
-                    continue
                 except PermissionError:
                     logging.error(f'Unable to delete {fullFilePath}: permissions')
-                    retry = retry + 1
+                    # keep accounting for it, but don't try it again this round
+                    skipped.append(file)
                     continue
+                self._forget(file)
+                evicted.append(file)
+            for file in skipped:
+                self.policy.add(file, self.photos[file], *self.displays.get(file, (0, 0)))
+            if self.manifest is not None:
+                self.manifest.commit()
+            logging.info(f'Evicted {len(evicted)} photos, {self.usedSpace / (1 << 20):.1f}(MB) in use')
+        for file in evicted:
+            self.emit(PHOTO_REMOVED_EVENT, file)
+
+    def recordDisplay(self, file):
+        # the slideshow showed this photo, which the policy uses to decide what's
+        # worth keeping. Counts live in the manifest so they survive restarts, but
+        # are only written every so many displays or minutes (and on cleanup)
+        with self.lock:
+            if file not in self.photos:
+                return
+            hits, _ = self.displays.get(file, (0, 0))
+            self.displays[file] = (hits + 1, time.time())
+            self.policy.touch(file, *self.displays[file])
+            self.unsavedDisplays.add(file)
+            if len(self.unsavedDisplays) >= DISPLAY_SAVE_COUNT or time.monotonic() - self.displaysSavedAt >= DISPLAY_SAVE_SECS:
+                self._save_displays()
+
+    def _save_displays(self):
+        if self.manifest is not None and len(self.unsavedDisplays) > 0:
+            self.manifest.executemany("UPDATE files SET hits = ?, lastShown = ? WHERE file = ?",
+                                      [(*self.displays[file], file) for file in self.unsavedDisplays if file in self.displays])
+            self.manifest.commit()
+        self.unsavedDisplays.clear()
+        self.displaysSavedAt = time.monotonic()
+
+    def _track(self, file, mtime, size, push = False, inode = None):
+        # push adds it to the policy straight away, otherwise _load_policy does
+        # it for everything at once. A file linked to one we already track adds
+        # nothing to usedSpace
+        self.photos[file] = mtime
+        self.sizes[file] = size
+        charge = size
+        if inode is not None:
+            links = self.inodes.setdefault(inode, set())
+            if len(links) > 0:
+                charge = 0
+            links.add(file)
+            self.fileInodes[file] = inode
+        self.charges[file] = charge
+        self.usedSpace += charge
+        if push:
+            self.policy.add(file, mtime, *self.displays.get(file, (0, 0)))
+
+    def _load_policy(self):
+        self.policy.load((file, mtime, *self.displays.get(file, (0, 0))) for file, mtime in self.photos.items())
 
+    def _forget(self, file, keepId = False):
+        if file in self.photos:
+            self.photos.pop(file)
+            self.sizes.pop(file)
+            charge = self.charges.pop(file)
+            inode = self.fileInodes.pop(file, None)
+            if inode is not None:
+                links = self.inodes[inode]
+                links.discard(file)
+                if len(links) == 0:
+                    del self.inodes[inode]
+                elif charge > 0:
+                    # the space is only freed with the last link, which takes over the charge
+                    self.charges[next(iter(links))] = charge
+                    charge = 0
+            self.usedSpace -= charge
+            self.policy.remove(file)
+        if not keepId:
+            self.displays.pop(file, None)
+            self.unsavedDisplays.discard(file)
+        if file in self.fileIds and not keepId:
+            self.ids.pop(self.fileIds.pop(file), None)
+        if self.manifest is not None and not keepId:
+            self.manifest.execute("DELETE FROM files WHERE file = ?", (file,))
+
+    def _open_manifest(self, manifestPath):
+        manifest = sqlite3.connect(manifestPath, check_same_thread=False)
+        manifest.execute("""CREATE TABLE IF NOT EXISTS files (
+            file TEXT PRIMARY KEY,
+            id TEXT,
+            size INTEGER,
+            mtime REAL,
+            checksum TEXT,
+            metadata TEXT,
+            hits INTEGER DEFAULT 0,
+            lastShown REAL DEFAULT 0,
+            inode TEXT)""")
+        # manifests written before display counts were kept
+        columns = [row[1] for row in manifest.execute("PRAGMA table_info(files)")]
+        if "hits" not in columns:
+            manifest.execute("ALTER TABLE files ADD COLUMN hits INTEGER DEFAULT 0")
+            manifest.execute("ALTER TABLE files ADD COLUMN lastShown REAL DEFAULT 0")
+        # and before hard linked duplicates were counted once
+        if "inode" not in columns:
+            manifest.execute("ALTER TABLE files ADD COLUMN inode TEXT")
+        # the manifest is rebuilt by reconcile() if it's ever lost, so don't pay
+        # for a full sync on every write to the SD card
+        manifest.execute("PRAGMA journal_mode=WAL")
+        manifest.execute("PRAGMA synchronous=NORMAL")
+        manifest.commit()
+        return manifest
+
+    def _write_manifest(self, file, id, size, mtime, checksum = None, metadata = None, inode = None):
+        if self.manifest is None:
+            return
+        self.manifest.execute("INSERT INTO files (file, id, size, mtime, checksum, metadata, inode) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                              "ON CONFLICT(file) DO UPDATE SET id = coalesce(excluded.id, id), size = excluded.size, mtime = excluded.mtime, "
+                              "checksum = coalesce(excluded.checksum, checksum), metadata = coalesce(excluded.metadata, metadata), "
+                              "inode = coalesce(excluded.inode, inode)",
+                              (file, id, size, mtime, checksum, json.dumps(metadata) if metadata is not None else None, inode))
+
+    def getChecksum(self, file):
+        # the checksum of the asset the file was last saved for
+        if self.manifest is None:
+            return None
+        with self.lock:
+            row = self.manifest.execute("SELECT checksum FROM files WHERE file = ?", (file,)).fetchone()
+        return row[0] if row else None
+
+    def getMetadata(self, file):
+        if self.manifest is None:
+            return None
+        with self.lock:
+            row = self.manifest.execute("SELECT metadata FROM files WHERE file = ?", (file,)).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def cleanup(self):
+        if self.reconcileThread is not None:
+            self.reconcileThread.join()
+        with self.lock:
+            self._save_displays()
+            if self.manifest is not None:
+                self.manifest.commit()
+                self.manifest.close()
+                self.manifest = None
+
+    def _remove_file(self, fullFilePath):
+        os.unlink(fullFilePath)
@@ -0,0 +1,16 @@
+# Raw frames: a photo already converted to the display's pixel format, so the
+# slideshow can map it and blit it without decoding the JPEG. A frame is a
+# 12 byte header (magic, width, height, bytes per pixel) followed by rows of
+# packed pixels with no padding. RGB565 is little endian, red in the top bits.
+import struct
+from os import path
+
+FRAME_MAGIC = b"FRM1"
+FRAME_HEADER = struct.Struct("<4sHHB3x")
+FRAME_FORMATS = {
+    "rgb565": 2,
+    "rgb888": 3
+}
+
+def frameName(file: str) -> str:
+    return path.splitext(file)[0] + ".frame"
@@ -0,0 +1,80 @@
+import logging
+import os
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+from PIL import Image
+
+from CacheLayout import CacheLayout
+from FrameFormat import FRAME_FORMATS, FRAME_HEADER, FRAME_MAGIC, frameName
+
+class FrameStore:
+    # Raw, display-ready copies of the photos in the cache (see FrameFormat). The
+    # JPEG stays the real copy: a frame only saves the slideshow a decode, so
+    # frames get their own space budget, the oldest go first, and a photo without
+    # one is just decoded as before.
+    def __init__(self, root: str, sharded: bool, format: str, maxSpace: int) -> None:
+        self.layout = CacheLayout(root, sharded)
+        self.bytesPerPixel = FRAME_FORMATS[format]
+        self.maxSpace = maxSpace
+        # frame name -> size, oldest first
+        self.frames = OrderedDict()
+        self.usedSpace = 0
+        self.lock = Lock()
+        os.makedirs(root, exist_ok=True)
+        existing = []
+        for file, fullPath in self.layout.listFiles():
+            if file.endswith(".frame"):
+                stat = os.stat(fullPath)
+                existing.append((stat.st_mtime, file, stat.st_size))
+        for mtime, file, size in sorted(existing):
+            self.frames[file] = size
+            self.usedSpace += size
+        logging.info(f'Frame store at {root} holds {len(self.frames)} {format} frames, {self.usedSpace / (1 << 20):.1f}(MB)')
+        with self.lock:
+            self._trim()
+
+    def encode(self, image: Image) -> bytes:
+        pixels = np.asarray(image.convert("RGB"))
+        if self.bytesPerPixel == 3:
+            return pixels.tobytes()
+        pixels = pixels.astype(np.uint16)
+        packed = ((pixels[..., 0] >> 3) << 11) | ((pixels[..., 1] >> 2) << 5) | (pixels[..., 2] >> 3)
+        return packed.astype("<u2").tobytes()
+
+    def write(self, file: str, image: Image):
+        # write the frame for a cached photo, replacing any older one. Goes through
+        # a temporary file so the slideshow never maps half a frame
+        name = frameName(file)
+        fullPath = self.layout.pathFor(name)
+        data = self.encode(image)
+        with open(fullPath + ".tmp", "wb") as frame:
+            frame.write(FRAME_HEADER.pack(FRAME_MAGIC, image.size[0], image.size[1], self.bytesPerPixel))
+            frame.write(data)
+        os.replace(fullPath + ".tmp", fullPath)
+        with self.lock:
+            self.usedSpace -= self.frames.pop(name, 0)
+            self.frames[name] = FRAME_HEADER.size + len(data)
+            self.usedSpace += self.frames[name]
+            self._trim()
+
+    def remove(self, file: str):
+        name = frameName(file)
+        with self.lock:
+            if name not in self.frames:
+                return
+            self.usedSpace -= self.frames.pop(name)
+            self._remove_file(name)
+
+    def _trim(self):
+        while self.usedSpace > self.maxSpace and len(self.frames) > 0:
+            name, size = self.frames.popitem(last=False)
+            self.usedSpace -= size
+            self._remove_file(name)
+
+    def _remove_file(self, name):
+        try:
+            os.unlink(self.layout.resolve(name))
+        except FileNotFoundError:
+            pass
@@ -1,23 +1,102 @@
 import os
+import tempfile
+import time
 from typing import Dict, List
+import logging
+from threading import Lock
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from Downloader import Downloader, Photo, Status
-from Constants import CONFIG_ALBUM_NAME, CONFIG_IMMICH_SERVER_URL, CONFIG_WORKING_DIR
+from Constants import CONFIG_ALBUM_NAME, CONFIG_ASYNC_CLIENT, CONFIG_IMMICH_SERVER_URL, CONFIG_MAX_REQUEST_RATE, CONFIG_PIPELINE_WORKERS, CONFIG_RENDITION_SIZES, CONFIG_REQUEST_RETRIES, CONFIG_REQUEST_TIMEOUT, CONFIG_SPOOL_THRESHOLD_MB, CONFIG_WORKING_DIR
 from urllib.parse import quote
 from PIL import Image
 
 class ImmichDownloader(Downloader):
   def __init__(self, config) -> None:
-    super().__init__()
+    if CONFIG_MAX_REQUEST_RATE in config:
+      super().__init__(config[CONFIG_MAX_REQUEST_RATE])
+    else:
+      super().__init__()
     self.albumName = config[CONFIG_ALBUM_NAME]
     self.workingDir = config[CONFIG_WORKING_DIR]
     self.server_url = config[CONFIG_IMMICH_SERVER_URL]
     self.accessToken = None
     self.timelineBuckets = None
+    # in-memory downloads bigger than this spill over to a temp file
+    if CONFIG_SPOOL_THRESHOLD_MB in config:
+      self.spoolThreshold = config[CONFIG_SPOOL_THRESHOLD_MB] * (1 << 20)
+    else:
+      self.spoolThreshold = 16 * (1 << 20)
+    # (connect, read) timeouts in seconds. A single number is used for both
+    if CONFIG_REQUEST_TIMEOUT in config and isinstance(config[CONFIG_REQUEST_TIMEOUT], (int, float)):
+      self.timeout = (config[CONFIG_REQUEST_TIMEOUT], config[CONFIG_REQUEST_TIMEOUT])
+    elif CONFIG_REQUEST_TIMEOUT in config:
+      self.timeout = tuple(config[CONFIG_REQUEST_TIMEOUT])
+    else:
+      self.timeout = (5, 30)
+    if CONFIG_REQUEST_RETRIES in config:
+      retries = config[CONFIG_REQUEST_RETRIES]
+    else:
+      retries = 3
+    # one pooled connection per download worker, plus one for listing
+    downloadWorkers = 2
+    if CONFIG_PIPELINE_WORKERS in config and "download" in config[CONFIG_PIPELINE_WORKERS]:
+      downloadWorkers = config[CONFIG_PIPELINE_WORKERS]["download"]
+    self.session = self._create_session(downloadWorkers + 1, retries)
+    self.credentials = None
+    self.loginLock = Lock()
+    # longest edge of the server's generated renditions, smallest first
+    self.renditionSizes = {"thumbnail": 250, "preview": 1440}
+    if CONFIG_RENDITION_SIZES in config:
+      self.renditionSizes.update(config[CONFIG_RENDITION_SIZES])
+    # per rendition: [photos, bytes downloaded, estimated bytes saved against preview]
+    self.renditionStats = {}
+    self.statsLock = Lock()
 
   def initialize(self):
     pass
 
+  def _create_session(self, poolSize, retries) -> requests.Session:
+    # a keep-alive session, so we don't pay a TCP + TLS handshake for every request.
+    # Connection errors and gateway errors on GETs are retried with exponential
+    # backoff; 429/503 are left to the rate limiter
+    retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=[500, 502, 504],
+                  allowed_methods=["GET"], raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolSize, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+  def _request(self, method, url, **kwargs) -> requests.Response:
+    # every call to the server goes through the shared rate limiter, and tells
+    # it how the server coped. If our token has expired, log in again and retry once
+    token = self.accessToken
+    response = self._send(method, url, **kwargs)
+    if response.status_code == 401 and self.credentials is not None:
+      logging.info("Access token rejected, logging in again")
+      response.close()
+      self._relogin(token)
+      response = self._send(method, url, **kwargs)
+    return response
+
+  def _send(self, method, url, **kwargs) -> requests.Response:
+    headers = kwargs.pop("headers", {})
+    if self.accessToken is not None:
+      headers["Authorization"] = f"Bearer {self.accessToken}"
+    self.rateLimiter.acquire()
+    start = time.monotonic()
+    response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+    self.rateLimiter.onResponse(response.status_code, time.monotonic() - start, response.headers.get("Retry-After"))
+    return response
+
+  def _relogin(self, expiredToken):
+    with self.loginLock:
+      # another thread may have already logged in again while we waited
+      if self.accessToken == expiredToken:
+        self._login(*self.credentials)
+
   def getIDForPhoto(self, photo):
     return photo['id']
   
@@ -30,53 +109,148 @@ class ImmichDownloader(Downloader):
   def getCreatedDateForPhoto(self, photo):
     return photo['fileCreatedAt']
 
-  def getTimelineBuckets(self) -> List[Dict[str, object]]:
-    headers = {
-        "Authorization": f"Bearer {self.accessToken}"
-    }
+  def getChecksumForPhoto(self, photo):
+    return photo.get('checksum')
+
+  def getTypeForPhoto(self, photo):
+    return photo.get('type', 'IMAGE')
+
+  def _buckets_url(self) -> str:
+    return f"{self.server_url}/api/timeline/buckets?isArchived=false&size=MONTH&withPartners=true&withStacked=true"
+
+  def _bucket_url(self, bucket_id: str) -> str:
+    return f"{self.server_url}/api/timeline/bucket?isArchived=false&size=MONTH&timeBucket={quote(bucket_id)}&withPartners=true&withStacked=true"
+
+  def _photo_url(self, photo, rendition: str) -> str:
+    if rendition == "original":
+      return f"{self.server_url}/api/assets/{photo['id']}/original"
+    return f"{self.server_url}/api/assets/{photo['id']}/thumbnail?size={rendition}"
+
+  def _pick_rendition(self, photo) -> str:
+    # the smallest rendition that still covers the screen without upscaling. Fall
+    # back to the preview when we don't know enough about the photo
+    try:
+      width, height = self.getDimensionsForPhoto(photo)
+      # the EXIF dimensions are as stored, orientations 5 to 8 turn the photo on its side
+      if str(photo['exifInfo'].get('orientation')) in ("5", "6", "7", "8"):
+        width, height = height, width
+    except (KeyError, TypeError, AttributeError):
+      return "preview"
+    if not width or not height or not self.screenSize[0] or not self.screenSize[1]:
+      return "preview"
+
+    longestEdge = max(width, height)
+    neededEdge = max(self.screenSize[0] / width, self.screenSize[1] / height) * longestEdge
+    for rendition, size in sorted(self.renditionSizes.items(), key=lambda item: item[1]):
+      if min(size, longestEdge) >= neededEdge or size >= longestEdge:
+        return rendition
 
+    # only fetch originals we know we can decode
+    extension = os.path.splitext(self.getFileNameForPhoto(photo))[1].upper()
+    if extension in (".JPG", ".JPEG", ".PNG"):
+      return "original"
+    return "preview"
+
+  def _conditional_headers(self, url, destination) -> Dict[str, str]:
+    # if we still have the file from last time, only ask for it if it changed
+    if destination is None or self.contentIndex is None or not os.path.exists(destination):
+      return {}
+    etag = self.contentIndex.getETag(url)
+    if etag is None:
+      return {}
+    return {"If-None-Match": etag}
+
+  def _store_etag(self, url, etag):
+    if self.contentIndex is not None:
+      self.contentIndex.setETag(url, etag)
+
+  def _record_download(self, photo, rendition: str, numBytes: int):
+    # estimate what the preview would have cost from the pixel count
+    saved = 0
+    try:
+      width, height = self.getDimensionsForPhoto(photo)
+      longestEdge = max(width, height)
+      renditionEdge = longestEdge if rendition == "original" else min(longestEdge, self.renditionSizes[rendition])
+      previewEdge = min(longestEdge, self.renditionSizes["preview"])
+      saved = round(numBytes * (previewEdge / renditionEdge) ** 2) - numBytes
+    except (KeyError, TypeError, ZeroDivisionError):
+      pass
+    with self.statsLock:
+      stats = self.renditionStats.setdefault(rendition, [0, 0, 0])
+      stats[0] += 1
+      stats[1] += numBytes
+      stats[2] += saved
+    logging.info(f"Downloaded {rendition} of {self.getFileNameForPhoto(photo)}: {numBytes} bytes, ~{saved} saved against preview")
+
+  def getTimelineBuckets(self) -> List[Dict[str, object]]:
     # first get the list of albums
-    buckets_url = f"{self.server_url}/api/timeline/buckets?isArchived=false&size=MONTH&withPartners=true&withStacked=true"
-    response = requests.get(buckets_url, headers=headers)
+    buckets_url = self._buckets_url()
+    response = self._request("GET", buckets_url)
     response.raise_for_status()
     self.timelineBuckets = response.json()
     return self.timelineBuckets
   
   def getPhotosForBucket(self, bucket_id: str) -> List[Photo]:
-    headers = {
-        "Authorization": f"Bearer {self.accessToken}"
-    }
-
-    buckets_url = f"{self.server_url}/api/timeline/bucket?isArchived=false&size=MONTH&timeBucket={quote(bucket_id)}&withPartners=true&withStacked=true"
-    response = requests.get(buckets_url, headers=headers)
+    buckets_url = self._bucket_url(bucket_id)
+    response = self._request("GET", buckets_url)
     response.raise_for_status()
     photos = response.json()
     return [Photo(photo, self) for photo in photos]
 
-  def downloadPhoto(self, photo, destination):
-    headers = {
-        "Authorization": f"Bearer {self.accessToken}" 
-    }
+  def downloadPhoto(self, photo, destination = None):
+    rendition = self._pick_rendition(photo)
+    photo_url = self._photo_url(photo, rendition)
+    # streamed responses hold on to their pooled connection until they're closed
+    with self._request("GET", photo_url, stream=True, headers=self._conditional_headers(photo_url, destination)) as response:
+      response.raise_for_status()
+      if response.status_code == 304:
+        logging.info(f"{self.getFileNameForPhoto(photo)} not modified, using {destination}")
+        return Image.open(destination)
+      self._store_etag(photo_url, response.headers.get("ETag"))
+      numBytes = 0
 
-    photo_url = f"{self.server_url}/api/assets/{photo['id']}/thumbnail?size=preview"
-    response = requests.get(photo_url, headers=headers, stream=True)
-    response.raise_for_status()
+      if destination is None:
+        # keep the photo in memory, unless it's unusually big, and decode straight from there
+        buffer = tempfile.SpooledTemporaryFile(max_size=self.spoolThreshold)
+        for chunk in response.iter_content(chunk_size=65536):
+          buffer.write(chunk)
+          numBytes += len(chunk)
+        buffer.seek(0)
+        self._record_download(photo, rendition, numBytes)
+        return Image.open(buffer)
 
-    # Save the photo to the specified download folder
-    with open(destination, 'wb') as photo_file:
-        for chunk in response.iter_content(chunk_size=8192):
-            photo_file.write(chunk)
+      # Save the photo to the specified download folder
+      with open(destination, 'wb') as photo_file:
+          for chunk in response.iter_content(chunk_size=8192):
+              photo_file.write(chunk)
+              numBytes += len(chunk)
+      self._record_download(photo, rendition, numBytes)
     
     # now return a PIL image from this file
     return Image.open(destination)
 
   def authenticate(self, userName, password):
+    self._login(userName, password)
+    # remember the credentials so we can log in again when the token expires
+    self.credentials = (userName, password)
+    self.status = Status.LoggedIn
+
+  def _login(self, userName, password):
     auth_url = f"{self.server_url}/api/auth/login"
     payload = {
         "email": userName,
         "password": password
     }
-    response = requests.post(auth_url, json=payload)
+    response = self._send("POST", auth_url, json=payload)
     response.raise_for_status()
     self.accessToken = response.json()['accessToken']
-    self.status = Status.LoggedIn
\ No newline at end of file
+
+def createImmichDownloader(config) -> ImmichDownloader:
+  # the asyncio client needs aiohttp, so fall back to the plain one without it
+  if CONFIG_ASYNC_CLIENT in config and config[CONFIG_ASYNC_CLIENT]:
+    try:
+      from AsyncImmichDownloader import AsyncImmichDownloader
+      return AsyncImmichDownloader(config)
+    except ModuleNotFoundError:
+      logging.error("aiohttp not installed, async Immich client is disabled")
+  return ImmichDownloader(config)
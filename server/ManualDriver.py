@@ -8,7 +8,7 @@ import logging
 from os import mkdir, path
 from Constants import STATUS_CHANGED_EVENT
 from PhotoProcessor import PhotoProcessor
-from ImmichDownloader import ImmichDownloader
+from ImmichDownloader import createImmichDownloader
 
 def downloaderStatusChanged(status):
     logging.info(f"Downloader status changed to {status}")
@@ -32,7 +32,7 @@ def main():
     else:
         logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(message)s')
     logging.info("Starting server")
-    downloader = ImmichDownloader(config)
+    downloader = createImmichDownloader(config)
     downloader.on(STATUS_CHANGED_EVENT, downloaderStatusChanged)
     fetcher = PhotoProcessor(downloader, config)
     downloader.authenticate(config["userName"], config["password"])
@@ -0,0 +1,120 @@
+import logging
+import sqlite3
+from threading import Lock
+from typing import Dict, Set, Tuple
+
+import numpy as np
+from PIL import Image
+
+def dhash(image: Image) -> int:
+    # 64 bit difference hash: shrink to 9x8 greyscale and record whether each
+    # pixel is brighter than its right hand neighbour
+    pixels = np.asarray(image.convert("L").resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+def hammingDistance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+class BKTree:
+    # metric tree over hashes: finding everything within a small Hamming distance
+    # only visits a fraction of the nodes
+    def __init__(self) -> None:
+        self.root: Tuple[int, Dict[int, object]] = None
+
+    def add(self, hash: int):
+        if self.root is None:
+            self.root = (hash, {})
+            return
+        node = self.root
+        while True:
+            distance = hammingDistance(hash, node[0])
+            if distance == 0:
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = (hash, {})
+                return
+            node = child
+
+    def find(self, hash: int, threshold: int):
+        # yields (distance, hash) for every hash within threshold
+        if self.root is None:
+            return
+        candidates = [self.root]
+        while candidates:
+            node = candidates.pop()
+            distance = hammingDistance(hash, node[0])
+            if distance <= threshold:
+                yield distance, node[0]
+            for childDistance, child in node[1].items():
+                if distance - threshold <= childDistance <= distance + threshold:
+                    candidates.append(child)
+
+class PerceptualIndex:
+    # Perceptual hashes of every photo we've rendered, to spot bursts and
+    # near-identical shots before we spend face detection on them. Kept in
+    # SQLite and loaded into a BK-tree at startup. Assets that were skipped as a
+    # near duplicate are remembered too, along with the photo they look like, so
+    # they aren't downloaded and decoded again on every pass while it's around.
+    def __init__(self, dbPath: str) -> None:
+        self.lock = Lock()
+        self.tree = BKTree()
+        self.files: Dict[int, str] = {}
+        self.suppressed: Dict[str, str] = {}
+        self.db = sqlite3.connect(dbPath, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS hashes (hash TEXT PRIMARY KEY, fileName TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS suppressed (assetId TEXT PRIMARY KEY, fileName TEXT)")
+        self.db.commit()
+        for hash, fileName in self.db.execute("SELECT hash, fileName FROM hashes"):
+            self.tree.add(int(hash, 16))
+            self.files[int(hash, 16)] = fileName
+        for assetId, fileName in self.db.execute("SELECT assetId, fileName FROM suppressed"):
+            self.suppressed[assetId] = fileName
+        logging.info(f"Perceptual index at {dbPath} with {len(self.files)} hashes and {len(self.suppressed)} suppressed assets")
+
+    def findNear(self, hash: int, threshold: int):
+        # returns (hash, fileName, distance) of the closest indexed photo within threshold
+        with self.lock:
+            matches = [(distance, match) for distance, match in self.tree.find(hash, threshold) if match in self.files]
+            if len(matches) == 0:
+                return None, None, None
+            distance, match = min(matches)
+            return match, self.files[match], distance
+
+    def add(self, hash: int, fileName: str):
+        with self.lock:
+            self.tree.add(hash)
+            self.files[hash] = fileName
+            self.db.execute("INSERT OR REPLACE INTO hashes (hash, fileName) VALUES (?, ?)", (f"{hash:016x}", fileName))
+            self.db.commit()
+
+    def remove(self, hash: int):
+        # the tree can't drop nodes, so the hash just stops counting as a match
+        with self.lock:
+            self.files.pop(hash, None)
+            self.db.execute("DELETE FROM hashes WHERE hash = ?", (f"{hash:016x}",))
+            self.db.commit()
+
+    def suppress(self, assetId: str, fileName: str):
+        # assetId was skipped because it looks like fileName
+        with self.lock:
+            self.suppressed[assetId] = fileName
+            self.db.execute("INSERT OR REPLACE INTO suppressed (assetId, fileName) VALUES (?, ?)", (assetId, fileName))
+            self.db.commit()
+
+    def suppressedIds(self, present: Set[str]) -> Set[str]:
+        # the assets still held back by a photo in present. The rest are forgotten,
+        # their look-alike has gone so they get a chance of their own
+        with self.lock:
+            released = [assetId for assetId, fileName in self.suppressed.items() if fileName not in present]
+            for assetId in released:
+                del self.suppressed[assetId]
+            if len(released) > 0:
+                self.db.executemany("DELETE FROM suppressed WHERE assetId = ?", [(assetId,) for assetId in released])
+                self.db.commit()
+            return set(self.suppressed.keys())
+
+    def cleanup(self):
+        with self.lock:
+            self.db.close()
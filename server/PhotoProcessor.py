@@ -1,20 +1,29 @@
 import pygame
 import logging
-import face_recognition
 import numpy as np
 from threading import Thread
-from random import choices, randint, choice
 from math import trunc
-from PIL import Image
-from os import environ, path, remove
+from PIL import Image, ImageOps
+from os import environ, link, makedirs, path, remove
+from threading import Lock
 from FileCache import FileCache
+from Pipeline import Pipeline
+from FaceDetector import FaceDetectionTimeout, FaceDetector
+from AnalysisCache import AnalysisCache, FaceAnalysis
+from AssetCatalog import AssetCatalog
+from ContentIndex import ContentIndex
+from PerceptualIndex import PerceptualIndex, dhash
+from PhotoSampler import PhotoSampler
+from FrameStore import FrameStore
+from FrameFormat import FRAME_FORMATS
 from pyicloud.services.photos import PhotoAlbum
+from typing import List
 from SlideshowInterface import SlideshowInterface
-import time
 import piexif
+from datetime import datetime
 
 from Downloader import STATUS_CHANGED_EVENT, Downloader, Photo, Status
-from Constants import CONFIG_ALBUM_NAME, CONFIG_IPC_SOCKET, CONFIG_KEEP_ORIGINAL_FILES, CONFIG_MAXSIZE, CONFIG_RECENCY_BIAS, CONFIG_RESIZE_IMAGE, CONFIG_STATUS_SOCKET, CONFIG_WORKING_DIR
+from Constants import CONFIG_ALBUM_NAME, CONFIG_CACHE_LOW_WATERMARK, CONFIG_DATA_DIR, CONFIG_EVICTION_POLICY, CONFIG_FACE_DETECTION_MAX_EDGE, CONFIG_FACE_DETECTION_TIMEOUT, CONFIG_FACE_DETECTION_WORKERS, CONFIG_IN_MEMORY_DOWNLOADS, CONFIG_IPC_SOCKET, CONFIG_KEEP_ORIGINAL_FILES, CONFIG_MAXSIZE, CONFIG_NEAR_DUPLICATE_THRESHOLD, CONFIG_PIPELINE_QUEUE_SIZE, CONFIG_PIPELINE_WORKERS, CONFIG_RAW_FRAMES, CONFIG_RAW_FRAMES_MB, CONFIG_RECENCY_BIAS, CONFIG_RESIZE_IMAGE, CONFIG_SHARDED_CACHE, CONFIG_STATUS_SOCKET, CONFIG_WATCH_CACHE, CONFIG_WORKING_DIR, PHOTO_ADDED_EVENT, PHOTO_REMOVED_EVENT
 
 canConvertHeif = True
 try:
@@ -30,6 +39,49 @@ zeroth_ifd = {
     piexif.ImageIFD.Software: u"piexif"
     }
 
+defaultPipelineWorkers = {
+    "download": 2,
+    "decode": 1,
+    "faces": 1,
+    "encode": 1
+}
+
+def renderedFileName(photo: Photo) -> str:
+    # the name the processed photo is saved under in the working dir
+    return path.splitext(photo.filename)[0] + ".JPEG"
+
+EXIF_DATE_FORMAT = "%Y:%m:%d %H:%M:%S"
+
+def exifDate(created) -> str:
+    # the photo's creation date in EXIF's format, which is what goes into the
+    # rendered JPEG and the slideshow's captions. Immich reports ISO-8601 in UTC
+    # (2023-05-12T10:20:30.000Z), which is shown in the frame's local time
+    if isinstance(created, datetime):
+        return created.strftime(EXIF_DATE_FORMAT)
+    try:
+        date = datetime.fromisoformat(created.replace("Z", "+00:00"))
+    except ValueError:
+        return created
+    if date.tzinfo is not None:
+        date = date.astimezone()
+    return date.strftime(EXIF_DATE_FORMAT)
+
+class IngestJob:
+    # carries a single photo through the stages of the ingest pipeline
+    def __init__(self, photo: Photo):
+        self.photo = photo
+        self.image: Image = None
+        self.exif = None
+        self.fileName = renderedFileName(photo)
+        self.fullPath = None
+        self.numFaces = 0
+        # set when the downloaded picture was stored on its side and had to be turned
+        self.rotated = False
+        # set when the picture was already rendered for an asset with the same checksum
+        self.linked = False
+        # what the slideshow shows alongside the photo, kept in the cache manifest
+        self.metadata = None
+
 class PhotoProcessor:    
     photos = dict()
     photosAlbum: PhotoAlbum = None
@@ -41,10 +93,21 @@ class PhotoProcessor:
     finished: bool = False
     _status = "Waiting for iCloud Credentials"
     cache: FileCache = None
+    cacheWatcher = None
+    frameStore: FrameStore = None
     ipcSocket = 5001
     slideshowInterface: SlideshowInterface = None
     keepOriginalFiles: bool = False
+    inMemoryDownloads: bool = True
     rejectedPhotos = []
+    pipeline: Pipeline = None
+    faceDetector: FaceDetector = None
+    analysisCache: AnalysisCache = None
+    catalog: AssetCatalog = None
+    contentIndex: ContentIndex = None
+    perceptualIndex: PerceptualIndex = None
+    nearDuplicateThreshold: int = 4
+    numFailedPhotos = 0
     
     def __init__(self, downloader: Downloader, config):
         logging.getLogger().setLevel(logging.INFO)
@@ -60,14 +123,80 @@ class PhotoProcessor:
             keepOriginalFiles = config[CONFIG_KEEP_ORIGINAL_FILES]
         else:
             keepOriginalFiles = False
+        pipelineWorkers = dict(defaultPipelineWorkers)
+        if CONFIG_PIPELINE_WORKERS in config:
+            pipelineWorkers.update(config[CONFIG_PIPELINE_WORKERS])
+        if CONFIG_PIPELINE_QUEUE_SIZE in config:
+            pipelineQueueSize = config[CONFIG_PIPELINE_QUEUE_SIZE]
+        else:
+            pipelineQueueSize = 4
+        if CONFIG_FACE_DETECTION_WORKERS in config:
+            faceDetectionWorkers = config[CONFIG_FACE_DETECTION_WORKERS]
+        else:
+            faceDetectionWorkers = 0
+        if CONFIG_FACE_DETECTION_TIMEOUT in config:
+            faceDetectionTimeout = config[CONFIG_FACE_DETECTION_TIMEOUT]
+        else:
+            faceDetectionTimeout = 60
+        if CONFIG_FACE_DETECTION_MAX_EDGE in config:
+            faceDetectionMaxEdge = config[CONFIG_FACE_DETECTION_MAX_EDGE]
+        else:
+            faceDetectionMaxEdge = 0
+        if CONFIG_IN_MEMORY_DOWNLOADS in config:
+            self.inMemoryDownloads = config[CONFIG_IN_MEMORY_DOWNLOADS]
+        if CONFIG_NEAR_DUPLICATE_THRESHOLD in config:
+            self.nearDuplicateThreshold = config[CONFIG_NEAR_DUPLICATE_THRESHOLD]
+        if CONFIG_DATA_DIR in config:
+            dataDir = config[CONFIG_DATA_DIR]
+        else:
+            dataDir = path.join(path.dirname(path.realpath(__file__)), "../data")
+        if not path.isdir(dataDir):
+            makedirs(dataDir)
     
         logging.info("Initializing Collector with params: Album: " + str(self.albumName) + " Resize: " + str(resize) + " MaxSize: " + str(maxSize) + " WorkingDir: " + str(workingDir))
         self.finished = False
         self.resize = resize
         self.workingDir = workingDir
-        self.cache = FileCache(maxSize, workingDir)
+        if CONFIG_CACHE_LOW_WATERMARK in config:
+            lowWatermark = config[CONFIG_CACHE_LOW_WATERMARK]
+        else:
+            lowWatermark = None
+        sharded = CONFIG_SHARDED_CACHE in config and config[CONFIG_SHARDED_CACHE]
+        if CONFIG_EVICTION_POLICY in config:
+            evictionPolicy = config[CONFIG_EVICTION_POLICY]
+        else:
+            evictionPolicy = "lru"
+        self.cache = FileCache(maxSize, workingDir, lowWatermark, path.join(dataDir, "cache.db"), sharded, evictionPolicy)
+        # photos the pipeline has claimed a perceptual hash for or is writing, that
+        # aren't in the cache yet
+        self.inFlight = set()
+        if CONFIG_WATCH_CACHE in config and config[CONFIG_WATCH_CACHE]:
+            try:
+                from CacheWatcher import CacheWatcher
+                # our own writes reach the cache through the cache stage
+                self.cacheWatcher = CacheWatcher(self.cache, lambda file: file in self.inFlight)
+            except ModuleNotFoundError:
+                logging.error("inotify_simple not installed, cache watcher is disabled")
+        if CONFIG_RAW_FRAMES in config and config[CONFIG_RAW_FRAMES] in FRAME_FORMATS:
+            if CONFIG_RAW_FRAMES_MB in config:
+                rawFramesMb = config[CONFIG_RAW_FRAMES_MB]
+            else:
+                rawFramesMb = 1024
+            self.frameStore = FrameStore(path.join(workingDir, "frames"), sharded, config[CONFIG_RAW_FRAMES], rawFramesMb << 20)
         self.workerThread = Thread(target=self.worker)
-        self.slideshowInterface = SlideshowInterface(ipcSocket, statusPort)
+        self.failedLock = Lock()
+        self.faceDetector = FaceDetector(faceDetectionWorkers, faceDetectionTimeout, faceDetectionMaxEdge)
+        self.analysisCache = AnalysisCache(path.join(dataDir, "analysis.db"))
+        self.catalog = AssetCatalog(path.join(dataDir, "catalog.db"))
+        self.contentIndex = ContentIndex(path.join(dataDir, "content.db"))
+        self.perceptualIndex = PerceptualIndex(path.join(dataDir, "perceptual.db"))
+        self.pipeline = self._create_pipeline(pipelineWorkers, pipelineQueueSize)
+        self.slideshowInterface = SlideshowInterface(ipcSocket, statusPort, self.cache.recordDisplay)
+        # keep the slideshow's photo index up to date
+        self.cache.on(PHOTO_ADDED_EVENT, lambda file: self.sendSlideshowCommand("photoAdded", {"file": file, "metadata": self.cache.getMetadata(file)}))
+        self.cache.on(PHOTO_REMOVED_EVENT, lambda file: self.sendSlideshowCommand("photoRemoved", file))
+        if self.frameStore is not None:
+            self.cache.on(PHOTO_REMOVED_EVENT, lambda file: self.frameStore.remove(file))
         self.keepOriginalFiles = keepOriginalFiles
         self.downloader = downloader
         self.downloader.on(STATUS_CHANGED_EVENT, lambda status: self.onDownloaderStatusChanged(status))
@@ -81,6 +210,8 @@ class PhotoProcessor:
         screen = pygame.display.set_mode() # [0,0], pygame.OPENGL)
         self.screenSize = screen.get_size()
         pygame.display.quit()
+        self.downloader.screenSize = self.screenSize
+        self.downloader.contentIndex = self.contentIndex
 
     def onDownloaderStatusChanged(self, status):
         if status == Status.LoggedIn:
@@ -116,75 +247,98 @@ class PhotoProcessor:
         self.slideshowInterface.sendCommand(command, params)
 
     def worker(self):
+        # this thread is the listing stage of the ingest pipeline: it picks photos
+        # and feeds them to the download -> decode -> faces -> encode -> cache stages
         logging.info("Started FileCache Worker Thread")
         self._status = "Fetching Photos"
-        finishedIds = []
-        numFailedPhotos = 0
-        cachedBuckets = {}
+        self.numFailedPhotos = 0
+        self.pipeline.start()
 
-        # get the timeline buckets we have to work with
-        buckets = self.downloader.getTimelineBuckets()
+        # get the timeline buckets we have to work with. The catalog remembers
+        # what we listed last time, so only buckets that changed get listed again
+        buckets = self.catalog.sync(self.downloader)
+        if self.downloader.concurrentListing:
+            self.catalog.listStaleBuckets(self.downloader)
+        self._evict_deleted()
 
         # count up the total number of photos, which is the sum of 'count' entries in the buckets
         self.numPhotosInAlbum = 0
         for bucket in buckets:
             self.numPhotosInAlbum += bucket["count"]
 
-        weights = [(i / len(buckets))**(1 - self.recencyBias) for i in range(len(buckets))]
-        total_weight = sum(weights)
-        normalized_weights = [w / total_weight for w in weights]
+        # the sampler picks buckets with recency bias, weighted by how many photos
+        # they have left, and never hands out the same photo twice
+        sampler = PhotoSampler(buckets, self.recencyBias, lambda bucketName: self._prefilter_bucket(self.catalog.getPhotosForBucket(bucketName, self.downloader)))
 
         while not self.finished:
-            if (len(finishedIds) == self.numPhotosInAlbum):
-                self.finished = True
+            # main retrieval loop
+            photo = sampler.draw()
+            if photo is None:
                 self._status = "Finished"
                 break
 
-            # main retrieval loop
-            # pick a random timeline bucket from the list (with recency bias). Then get the photos from that bucket
-            # and store them in a cache dictionary
-            # Determine weights based on recency preference
-            # Download photos based on weights
-            bucket = choices(buckets, weights=normalized_weights)
-            
-            # if we've already cached this bucket, skip retrieval
-            bucketName = bucket[0]["timeBucket"]
-
-            if bucketName not in cachedBuckets:
-                photos = self.downloader.getPhotosForBucket(bucketName)
-                cachedBuckets[bucketName] = photos
-
-            # pick a random photo from the bucket
-            photoIndex = randint(0, len(cachedBuckets[bucketName]) - 1)
-
-            if photoIndex in finishedIds:
-                continue
-
-            # delay based on # of photos in the library
-            # this is to prevent the app from getting throttled by iCloud
-            # when we're downloading a lot of photos
-            delay = trunc(self.cache.numFiles / 100)
-            if delay < 1:
-                delay = 1
-            delay = randint(delay, delay * 2)
-            logging.info(f"Delaying {delay} seconds")
-            time.sleep(delay)
-
-            # try fetching the photo
-            try:
-                photo = cachedBuckets[bucketName][photoIndex]
-                if not self.cache.isPhotoInCache(photo):
-                    self.processPhoto(photo)
-            except Exception as e:
-                logging.error("Could not fetch photo: " + photo.filename + ": " + str(e))
-                numFailedPhotos = numFailedPhotos + 1
-            finally:
-                finishedIds.append(photo.id)
-                self.slideshowInterface.report("working", self.numPhotosInAlbum, self.cache.numFiles, numFailedPhotos)
-        
-        self.slideshowInterface.report("Finished", self.numPhotosInAlbum, self.cache.numFiles, numFailedPhotos)
+            # hand the photo to the pipeline. This blocks while the download stage is
+            # backed up, so we never list faster than we can ingest. Requests to the
+            # server are paced by the downloader's rate limiter
+            if not self.cache.isPhotoInCache(photo):
+                self.pipeline.submit(IngestJob(photo))
+
+        # let whatever is still in flight finish, unless we're shutting down
+        self.pipeline.drain()
+        # buckets listed during the pass may have turned up more deletions
+        self._evict_deleted()
+        self.finished = True
+        self.slideshowInterface.report("Finished", self.numPhotosInAlbum, self.cache.numFiles, self.numFailedPhotos)
+
+    def _evict_deleted(self):
+        # drop the photos of assets that were deleted on the server from the cache
+        deletedIds = self.catalog.deletedIds
+        # the ones we're done with. Any we couldn't evict are tried again next time
+        handled = []
+        evicted = 0
+        for assetId in deletedIds:
+            with self.cache.lock:
+                file = self.cache.ids.get(assetId)
+            if file is not None:
+                try:
+                    self.cache.deletePhoto(file)
+                    evicted += 1
+                except OSError as e:
+                    logging.error(f"Could not evict {file} of deleted asset {assetId}: {e}")
+                    continue
+            handled.append(assetId)
+        self.catalog.purgeDeleted(handled)
+        if len(deletedIds) > 0:
+            logging.info(f"{len(deletedIds)} assets were deleted on the server, {evicted} of them evicted from the cache")
 
     def processPhoto(self, photo: Photo):
+        # run a single photo through all the stages on the calling thread
+        job = IngestJob(photo)
+        for stage in [self._download_stage, self._decode_stage, self._faces_stage, self._encode_stage, self._cache_stage]:
+            job = stage(job)
+            if job is None:
+                # dropped along the way, e.g. as a near duplicate
+                return
+
+    def _create_pipeline(self, workers, queueSize) -> Pipeline:
+        pipeline = Pipeline(onError=self._on_pipeline_error)
+        pipeline.addStage("download", self._download_stage, workers["download"], queueSize)
+        pipeline.addStage("decode", self._decode_stage, workers["decode"], queueSize)
+        pipeline.addStage("faces", self._faces_stage, workers["faces"], queueSize)
+        pipeline.addStage("encode", self._encode_stage, workers["encode"], queueSize)
+        # the cache isn't thread safe, so it gets exactly one worker
+        pipeline.addStage("cache", self._cache_stage, 1, queueSize)
+        return pipeline
+
+    def _on_pipeline_error(self, job: IngestJob, e: Exception):
+        logging.error("Could not fetch photo: " + job.photo.filename + ": " + str(e))
+        self.inFlight.discard(job.fileName)
+        with self.failedLock:
+            self.numFailedPhotos = self.numFailedPhotos + 1
+        self.slideshowInterface.report("working", self.numPhotosInAlbum, self.cache.numFiles, self.numFailedPhotos)
+
+    def _download_stage(self, job: IngestJob) -> IngestJob:
+        photo = job.photo
         logging.info(f"Picked photo {photo.filename} for processing")
         split = path.splitext(photo.filename)
 
@@ -192,38 +346,178 @@ class PhotoProcessor:
             logging.warning(f"Photo {photo.filename} is not usable")
             raise Exception("Photo is not usable")
 
-        self._status = f"Examining photo {photo.filename}"
+        if self._link_duplicate(job):
+            return job
+
         self._status = f"Downloading {photo.filename}"
-        image = photo.download(self._get_temp_path(photo.filename))
+        job.image = photo.download(self._get_download_path(photo))
 
-        if image == None:
+        if job.image == None:
             logging.error(f"Failed to download image {photo.filename}")
             raise Exception("Failed to download image")
-        
-        exif_dict = piexif.load(image.info["exif"])
-
-        fileName = split[0] + ".JPEG"
         logging.info(f"Download successful.")
-        numFaces = 0
+        return job
+
+    def _link_duplicate(self, job: IngestJob) -> bool:
+        # if we've already rendered an asset with the same content, hard link that
+        # file in under this photo's name instead of downloading it again
+        checksum = job.photo.checksum
+        existing = self.contentIndex.lookup(checksum)
+        if existing is None:
+            return False
+        existingPath = self.cache.layout.resolve(existing)
+        if not path.exists(existingPath):
+            # evicted since, so it has to be fetched again
+            self.contentIndex.remove(checksum)
+            return False
+        if self.cache.getChecksum(existing) != checksum:
+            # rendered names come from the original file name, so another asset
+            # with the same name may have been saved over it since
+            logging.info(f"{existing} no longer holds the content of {job.photo.filename}, not linking it")
+            self.contentIndex.remove(checksum)
+            return False
+
+        job.fullPath = self.cache.layout.pathFor(job.fileName)
+        if existingPath != job.fullPath and not path.exists(job.fullPath):
+            link(existingPath, job.fullPath)
+        job.linked = True
+        job.metadata = self.cache.getMetadata(existing)
+        logging.info(f"{job.photo.filename} has the same content as {existing}, not downloading it again")
+        return True
+
+    def _decode_stage(self, job: IngestJob) -> IngestJob:
+        if job.linked:
+            return job
+        # Image.open is lazy, so this is where the pixels actually get decoded.
+        # For JPEGs, ask the decoder to scale down by the largest power of two that
+        # still leaves the image at least as big as what we'll resize it to, so we
+        # never hold the full resolution image in memory
+        orientation = job.image.getexif().get(piexif.ImageIFD.Orientation, 1)
+        # orientations 5 to 8 have the photo stored on its side
+        sideways = orientation in (5, 6, 7, 8)
         if self.resize:
-            image, numFaces = self._scan_and_resize(image, fileName)
-            # and now just save it
-            logging.info(f"Resize of {fileName} successful.")
-        fullPath = self.workingDir + "/" + fileName
-        logging.info(f"Saving {fileName} to {fullPath}")
+            uprightSize = job.image.size[::-1] if sideways else job.image.size
+            targetSize = self._screen_fill_size(uprightSize)
+            if sideways:
+                targetSize = targetSize[::-1]
+            originalSize = job.image.size
+            if job.image.draft(job.image.mode, targetSize) is not None:
+                logging.info(f"Decoding {job.fileName} at {job.image.size} instead of {originalSize}")
+        job.image.load()
+        if "exif" in job.image.info:
+            job.exif = piexif.load(job.image.info["exif"])
+        else:
+            # smaller renditions can come without EXIF
+            job.exif = {"0th": {}, "Exif": {}, "GPS": {}, "1st": {}, "thumbnail": None}
+        if orientation != 1:
+            # originals are stored the way the camera was held, and neither face
+            # detection nor pygame look at the tag. Turn the pixels upright and
+            # drop the tag so nothing turns them again
+            job.image = ImageOps.exif_transpose(job.image)
+            job.exif["0th"].pop(piexif.ImageIFD.Orientation, None)
+            job.rotated = sideways
+
+        if self._is_near_duplicate(job):
+            # drop it here, before it costs us face detection and space in the cache
+            return None
+        return job
+
+    def _is_near_duplicate(self, job: IngestJob) -> bool:
+        if self.nearDuplicateThreshold <= 0:
+            return False
+        hash = dhash(job.image)
+        while True:
+            matchHash, match, distance = self.perceptualIndex.findNear(hash, self.nearDuplicateThreshold)
+            if match is None:
+                break
+            if match != job.fileName and (match in self.inFlight or self.cache.layout.exists(match)):
+                logging.info(f"Skipping {job.photo.filename}: looks like {match} (distance {distance})")
+                self.perceptualIndex.suppress(job.photo.id, match)
+                return True
+            # that photo has been evicted, it shouldn't hold this one back
+            self.perceptualIndex.remove(matchHash)
+        # claim the hash now, so a near duplicate that's right behind us in the pipeline gets skipped
+        self.perceptualIndex.add(hash, job.fileName)
+        self.inFlight.add(job.fileName)
+        return False
+
+    def _faces_stage(self, job: IngestJob) -> IngestJob:
+        if self.resize and not job.linked:
+            self._status = f"Examining photo {job.photo.filename}"
+            try:
+                job.image, job.numFaces = self._scan_and_resize(job.image, job.fileName, job.photo, job.rotated)
+            except FaceDetectionTimeout:
+                # nothing was stored in the analysis cache, so the photo gets analysed
+                # again the next time it's picked. Fail it for this pass
+                logging.error(f"Face detection didn't finish for {job.fileName}, skipping it for now")
+                raise
+            logging.info(f"Resize of {job.fileName} successful.")
+        return job
+
+    def _encode_stage(self, job: IngestJob) -> IngestJob:
+        if job.linked:
+            return job
+        photo = job.photo
+        job.fullPath = self.cache.layout.pathFor(job.fileName)
         originalPath = self._get_temp_path(photo.filename)
-        logging.info(f"Saving {fullPath}.")
+        logging.info(f"Saving {job.fullPath}.")
         # create the exif tag for the image
-        exif_dict["Exif"][piexif.ExifIFD.SubjectArea] = numFaces
-        date = photo.created
+        exif_dict = job.exif
+        exif_dict["Exif"][piexif.ExifIFD.SubjectArea] = job.numFaces
+        date = exifDate(photo.created)
         bDate = bytes(date, "utf-8")
         exif_dict["Exif"][piexif.ExifIFD.DateTimeOriginal] = bDate
         exif_bytes = piexif.dump(exif_dict)
-        image.save(fullPath, "JPEG", exif=exif_bytes)
-        if not self.keepOriginalFiles:
+        job.metadata = {"date": date, "faces": job.numFaces}
+        # keep the cache watcher off the file until the cache stage adds it
+        self.inFlight.add(job.fileName)
+        job.image.save(job.fullPath, "JPEG", exif=exif_bytes)
+        if self.frameStore is not None and self.resize:
+            # only resized photos are at screen size
+            self.frameStore.write(job.fileName, job.image)
+        if not self.keepOriginalFiles and path.exists(originalPath):
             remove(originalPath)
-
-        self.cache.addPhotoToCache(photo, fullPath)
+        self.contentIndex.add(photo.checksum, job.fileName)
+        return job
+
+    def _cache_stage(self, job: IngestJob) -> IngestJob:
+        self.cache.addPhotoToCache(job.photo, job.fullPath, job.metadata)
+        self.inFlight.discard(job.fileName)
+        self.slideshowInterface.report("working", self.numPhotosInAlbum, self.cache.numFiles, self.numFailedPhotos)
+        return None
+
+    def _prefilter_bucket(self, photos: List[Photo]) -> List[Photo]:
+        # drop everything in a freshly listed bucket that usePhoto would reject,
+        # using only the listing metadata, so the sampler never hands them out
+        if len(photos) == 0:
+            return photos
+        dimensions = np.array([self._listed_dimensions(photo) for photo in photos], dtype=np.int64)
+        ids = np.array([photo.id for photo in photos])
+        names = np.array([renderedFileName(photo) for photo in photos])
+        types = np.array([photo.type for photo in photos])
+        # the cache stage, the watcher and the reconcile thread all change the cache
+        # while we're listing, so take a snapshot
+        with self.cache.lock:
+            cached = set(self.cache.photos.keys()) | set(self.cache.ids.keys())
+        # and near duplicates of photos we still have
+        suppressed = self.perceptualIndex.suppressedIds(cached | set(self.inFlight))
+        skip = np.array(list(set(self.rejectedPhotos) | cached | suppressed), dtype=str)
+
+        width = dimensions[:, 0]
+        height = dimensions[:, 1]
+        mask = (width > 500) & (height > 500) & (width * height < 15000000) \
+            & (types != "VIDEO") \
+            & ~np.isin(ids, skip) & ~np.isin(names, skip)
+        eligible = [photos[i] for i in np.flatnonzero(mask)]
+        logging.info(f"{len(eligible)} of {len(photos)} photos in bucket are usable")
+        return eligible
+
+    def _listed_dimensions(self, photo: Photo) -> List[int]:
+        try:
+            width, height = photo.dimensions
+            return [width or 0, height or 0]
+        except (KeyError, TypeError):
+            return [0, 0]
 
     def usePhoto(self, photo, extension) -> bool:
         extension = extension.upper()
@@ -236,28 +530,26 @@ class PhotoProcessor:
             and photo.dimensions[0] * photo.dimensions[1] < 15000000
 
 
-    def _scan_and_resize(self, image:Image, name: str) -> Image:
+    def _scan_and_resize(self, image:Image, name: str, photo: Photo = None, rotated: bool = False) -> Image:
         logging.info(f"Scanning and Resizing {name}")
         # first resize the image
-        screenAspectRatio = self.screenSize[0] / self.screenSize[1]
-        imageAspectRatio = image.size[0] / image.size[1]
-        if imageAspectRatio > screenAspectRatio: #landscape
-            percent = self.screenSize[1] / image.size[1]
-        else:
-            percent = self.screenSize[0] / image.size[0]
-
-        newSize = (trunc(image.size[0] * percent), trunc(image.size[1] * percent))
+        newSize = self._screen_fill_size(image.size)
         logging.info(f"Resizing {name} to {newSize}")
         image = image.resize(newSize)
 
-        # now, do the face recognition block on that image
-        numFaces, startX, startY, endX, endY = self._get_face_bounding_rect(image, name)
+        # now, do the face recognition block on that image, unless we've already
+        # analysed this photo before
+        analysis = self._get_face_analysis(image, name, photo, rotated)
+        numFaces, startX, startY, endX, endY = self._get_face_bounding_rect(image, name, analysis)
 
+        # remember where we cropped, as fractions of the image
+        crop = [0.0, 0.0, 1.0, 1.0]
         if numFaces == 0:
             logging.warning(f"No faces detected in {name}")
             # just thumbnail the image to screen size, don't attempt to intelligently
             # resize it
             image.thumbnail(self.screenSize)
+            self._store_face_analysis(photo, analysis, crop)
             return image, 0
 
         # now we simply need to see how to best crop the resulting image
@@ -282,6 +574,8 @@ class PhotoProcessor:
                 startX = max(0, startX - (endX - image.size[0]))
                 endX = image.size[0]
             logging.info(f"Cropping {name} to {startX}, {startY}, {endX}, {endY}")
+            crop[0] = startX / image.size[0]
+            crop[2] = endX / image.size[0]
             image = image.crop((startX, 0, endX, image.size[1]))
 
         if image.size[1] > self.screenSize[1]:
@@ -302,13 +596,44 @@ class PhotoProcessor:
                 startY = max(0, startY - (endX - image.size[0]))
                 endY = image.size[0]
             logging.info(f"Cropping {name} to {startX}, {startY}, {endX}, {endY}")
+            crop[1] = startY / image.size[1]
+            crop[3] = endY / image.size[1]
             image = image.crop((0, startY, image.size[0], endY))
 
+        self._store_face_analysis(photo, analysis, crop)
         return image, numFaces
 
-    def _get_face_bounding_rect(self, image: Image, name: str):
-        im = image.convert('RGB')
-        face_locations = face_recognition.face_locations(np.array(im))
+    def _screen_fill_size(self, size):
+        # the size that scales the image to cover the whole screen
+        screenAspectRatio = self.screenSize[0] / self.screenSize[1]
+        imageAspectRatio = size[0] / size[1]
+        if imageAspectRatio > screenAspectRatio: #landscape
+            percent = self.screenSize[1] / size[1]
+        else:
+            percent = self.screenSize[0] / size[0]
+
+        return (trunc(size[0] * percent), trunc(size[1] * percent))
+
+    def _get_face_analysis(self, image: Image, name: str, photo: Photo = None, rotated: bool = False) -> FaceAnalysis:
+        if photo is not None:
+            analysis = self.analysisCache.get(photo.id, photo.checksum, rotated)
+            if analysis is not None:
+                logging.info(f"Reusing face analysis for {name}: {analysis.numFaces} faces")
+                return analysis
+        return FaceAnalysis.fromLocations(self.faceDetector.findFaces(image), image.size)
+
+    def _store_face_analysis(self, photo: Photo, analysis: FaceAnalysis, crop):
+        if photo is None:
+            return
+        analysis.crop = crop
+        analysis.screenSize = list(self.screenSize)
+        self.analysisCache.put(photo.id, photo.checksum, analysis)
+
+    def _get_face_bounding_rect(self, image: Image, name: str, analysis: FaceAnalysis = None):
+        if analysis is None:
+            face_locations = self.faceDetector.findFaces(image)
+        else:
+            face_locations = analysis.facesForSize(image.size)
 
         logging.info(f"Found {len(face_locations)} faces in {name}")
         startX = image.size[0]
@@ -330,6 +655,13 @@ class PhotoProcessor:
 
         return len(face_locations), startX, startY, endX, endY
 
+    def _get_download_path(self, photo: Photo) -> str:
+        # None tells the downloader to keep the original in memory. We only need
+        # it on disk when we've been asked to keep it
+        if self.inMemoryDownloads and not self.keepOriginalFiles:
+            return None
+        return self._get_temp_path(photo.filename)
+
     def _get_temp_path(self, filename) -> str:
         return "/tmp/photos/" + filename
 
@@ -364,7 +696,18 @@ class PhotoProcessor:
 
     def cleanup(self):
         self.finished = True
-        self.workerThread.join()
+        self.pipeline.stop()
+        if self.workerThread.is_alive():
+            self.workerThread.join()
+        self.faceDetector.cleanup()
+        self.analysisCache.cleanup()
+        self.catalog.cleanup()
+        self.contentIndex.cleanup()
+        self.perceptualIndex.cleanup()
+        if self.cacheWatcher is not None:
+            self.cacheWatcher.cleanup()
+        self.cache.cleanup()
+        self.downloader.cleanup()
         # write the rejected photos list back to rejected file
         with open("rejected.txt", 'w') as f:
             for photo in self.rejectedPhotos:
@@ -0,0 +1,98 @@
+import logging
+from random import random, randrange
+from typing import Callable, Dict, List
+
+from Downloader import Photo
+
+class FenwickTree:
+    # prefix sums over a list of weights, with O(log n) updates and lookups
+    def __init__(self, weights: List[float]) -> None:
+        self.size = len(weights)
+        self.tree = [0.0] * (self.size + 1)
+        for i, weight in enumerate(weights):
+            self.add(i, weight)
+
+    def add(self, index: int, delta: float):
+        index += 1
+        while index <= self.size:
+            self.tree[index] += delta
+            index += index & -index
+
+    @property
+    def total(self) -> float:
+        result = 0.0
+        index = self.size
+        while index > 0:
+            result += self.tree[index]
+            index -= index & -index
+        return result
+
+    def find(self, value: float) -> int:
+        # index of the first weight whose prefix sum exceeds value
+        index = 0
+        step = 1 << self.size.bit_length()
+        while step > 0:
+            next = index + step
+            if next <= self.size and self.tree[next] <= value:
+                index = next
+                value -= self.tree[next]
+            step >>= 1
+        return min(index, self.size - 1)
+
+class PhotoSampler:
+    # Draws photos without replacement across the timeline buckets. A bucket is
+    # picked with probability proportional to its recency weight times the number
+    # of photos it has left, then a photo is taken out of that bucket's pool.
+    # Buckets are only listed when they are first picked. Each draw costs
+    # O(log #buckets) no matter how many photos have already been drawn.
+    def __init__(self, buckets: List[Dict[str, object]], recencyBias: float, listBucket: Callable[[str], List[Photo]]) -> None:
+        self.buckets = buckets
+        self.listBucket = listBucket
+        # same recency curve as before, shifted so the first bucket isn't weighted 0
+        self.recency = [((i + 1) / len(buckets))**(1 - recencyBias) for i in range(len(buckets))]
+        self.weights = [self.recency[i] * bucket["count"] for i, bucket in enumerate(buckets)]
+        self.tree = FenwickTree(self.weights)
+        self.pools: List[List[Photo]] = [None] * len(buckets)
+        self.remaining = sum(bucket["count"] for bucket in buckets)
+
+    def draw(self) -> Photo:
+        # returns None once every photo has been drawn
+        while self.remaining > 0:
+            total = self.tree.total
+            if total <= 0:
+                break
+            index = self.tree.find(random() * total)
+            if self.weights[index] <= 0:
+                # rounding errors put us on an exhausted bucket. Rebuild the sums
+                # from the exact weights and retry
+                self.tree = FenwickTree(self.weights)
+                continue
+
+            pool = self.pools[index]
+            if pool is None:
+                pool = self._list(index)
+                if len(pool) == 0:
+                    continue
+
+            # swap the picked photo to the end so removing it is O(1)
+            pick = randrange(len(pool))
+            pool[pick], pool[-1] = pool[-1], pool[pick]
+            photo = pool.pop()
+            self.remaining -= 1
+            self._set_weight(index, self.recency[index] * len(pool))
+            return photo
+        return None
+
+    def _list(self, index: int) -> List[Photo]:
+        name = self.buckets[index]["timeBucket"]
+        pool = list(self.listBucket(name))
+        # the bucket count is only an estimate until we've actually listed it
+        self.remaining += len(pool) - self.buckets[index]["count"]
+        self.pools[index] = pool
+        self._set_weight(index, self.recency[index] * len(pool))
+        logging.info(f"Sampler listed bucket {name}: {len(pool)} photos")
+        return pool
+
+    def _set_weight(self, index: int, weight: float):
+        self.tree.add(index, weight - self.weights[index])
+        self.weights[index] = weight
@@ -0,0 +1,92 @@
+import logging
+import queue
+from threading import Event, Thread
+from typing import Callable, List
+
+class PipelineStage:
+    def __init__(self, name: str, func: Callable, numWorkers: int, queueSize: int):
+        self.name = name
+        self.func = func
+        self.numWorkers = max(1, numWorkers)
+        # bounded queue: a full queue blocks the previous stage, which gives us backpressure
+        self.queue = queue.Queue(maxsize=max(1, queueSize))
+        self.next: 'PipelineStage' = None
+        self.threads: List[Thread] = []
+
+class Pipeline:
+    # A chain of stages connected by bounded queues. Each stage has its own pool
+    # of worker threads. A stage function takes an item and returns the item to
+    # hand to the next stage, or None to drop it. Exceptions are passed to onError
+    # and the item is dropped.
+    pollInterval = 0.5
+
+    def __init__(self, onError: Callable = None):
+        self.stages: List[PipelineStage] = []
+        self.onError = onError
+        self._stopped = Event()
+
+    def addStage(self, name: str, func: Callable, numWorkers: int = 1, queueSize: int = 4):
+        stage = PipelineStage(name, func, numWorkers, queueSize)
+        if len(self.stages) > 0:
+            self.stages[-1].next = stage
+        self.stages.append(stage)
+        return stage
+
+    def start(self):
+        for stage in self.stages:
+            logging.info(f"Starting pipeline stage {stage.name} with {stage.numWorkers} worker(s)")
+            for i in range(stage.numWorkers):
+                thread = Thread(target=self._runStage, args=(stage,), name=f"{stage.name}-{i}")
+                stage.threads.append(thread)
+                thread.start()
+
+    @property
+    def stopped(self) -> bool:
+        return self._stopped.is_set()
+
+    def submit(self, item) -> bool:
+        # blocks while the first stage is full. Returns False if the pipeline was stopped
+        return self._put(self.stages[0], item)
+
+    def drain(self):
+        # wait for everything submitted so far to make it out the other end.
+        # Stages hand items downstream before marking them done, so joining
+        # the queues in order is enough.
+        for stage in self.stages:
+            while not self.stopped and stage.queue.unfinished_tasks > 0:
+                self._stopped.wait(self.pollInterval)
+
+    def stop(self):
+        self._stopped.set()
+        for stage in self.stages:
+            for thread in stage.threads:
+                thread.join()
+            stage.threads = []
+        logging.info("Pipeline stopped")
+
+    def _put(self, stage: PipelineStage, item) -> bool:
+        while not self.stopped:
+            try:
+                stage.queue.put(item, timeout=self.pollInterval)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _runStage(self, stage: PipelineStage):
+        while not self.stopped:
+            try:
+                item = stage.queue.get(timeout=self.pollInterval)
+            except queue.Empty:
+                continue
+
+            try:
+                result = stage.func(item)
+                if result is not None and stage.next is not None:
+                    self._put(stage.next, result)
+            except Exception as e:
+                logging.error(f"Pipeline stage {stage.name} failed: {e}")
+                if self.onError:
+                    self.onError(item, e)
+            finally:
+                stage.queue.task_done()
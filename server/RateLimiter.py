@@ -0,0 +1,82 @@
+import logging
+import time
+from email.utils import parsedate_to_datetime
+from threading import Lock
+
+class RateLimiter:
+    # Token bucket shared by every request a downloader makes. The refill rate
+    # adapts: it creeps up while responses are quick and successful, and is cut
+    # back when the server answers 429/503, sends Retry-After, or when latency
+    # climbs well above the best we've seen.
+    increaseStep = 0.25
+    decreaseFactor = 0.5
+    latencyDecreaseFactor = 0.8
+    latencyThreshold = 2.0
+    defaultRetryAfter = 5
+
+    def __init__(self, initialRate: float = 2.0, minRate: float = 0.05, maxRate: float = 20.0, burst: int = 4) -> None:
+        self.lock = Lock()
+        self._rate = initialRate
+        self.minRate = minRate
+        self.maxRate = max(minRate, maxRate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.lastRefill = time.monotonic()
+        self.blockedUntil = 0.0
+        self.averageLatency = None
+        self.baselineLatency = None
+
+    @property
+    def rate(self) -> float:
+        # current allowed requests per second
+        return round(self._rate, 2)
+
+    def acquire(self):
+        # blocks until a request may be made
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.lastRefill) * self._rate)
+                self.lastRefill = now
+                if now >= self.blockedUntil and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.blockedUntil - now, (1 - self.tokens) / self._rate)
+            time.sleep(wait)
+
+    def onResponse(self, statusCode: int, latency: float, retryAfter: str = None):
+        with self.lock:
+            if statusCode in (429, 503) or retryAfter is not None:
+                self._rate = max(self.minRate, self._rate * self.decreaseFactor)
+                delay = self._parse_retry_after(retryAfter)
+                self.blockedUntil = max(self.blockedUntil, time.monotonic() + delay)
+                self.tokens = 0
+                logging.warning(f"Server asked us to back off ({statusCode}), waiting {delay}s and dropping to {self.rate} requests/s")
+                return
+
+            if self.averageLatency is None:
+                self.averageLatency = latency
+                self.baselineLatency = latency
+            else:
+                self.averageLatency = 0.8 * self.averageLatency + 0.2 * latency
+                # let the baseline drift up slowly so a permanently slower server
+                # doesn't keep us throttled forever
+                self.baselineLatency = min(self.averageLatency, self.baselineLatency * 1.01)
+
+            if self.averageLatency > self.baselineLatency * self.latencyThreshold:
+                self._rate = max(self.minRate, self._rate * self.latencyDecreaseFactor)
+                logging.info(f"Latency rising ({self.averageLatency:.2f}s), dropping to {self.rate} requests/s")
+            elif statusCode < 400:
+                self._rate = min(self.maxRate, self._rate + self.increaseStep)
+
+    def _parse_retry_after(self, retryAfter: str) -> float:
+        if retryAfter is None:
+            return self.defaultRetryAfter
+        try:
+            return max(0.0, float(retryAfter))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(retryAfter).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return self.defaultRetryAfter
@@ -3,13 +3,17 @@ import logging
 import threading
 
 class SlideshowInterface:
-    def __init__(self, commandPort, statusPort):
+    def __init__(self, commandPort, statusPort, onDisplayedPhoto = None):
         self.commandContext = zmq.Context()
         self.commandSocket = self.commandContext.socket(zmq.PUB)
         self.commandSocket.bind("tcp://*:%s" % commandPort)
+        # the socket is shared by the worker, the pipeline stages and the cache's
+        # event handlers, and zmq sockets aren't thread safe
+        self.sendLock = threading.Lock()
 
         # start the status ingester
         self.displayedPhotos = []
+        self.onDisplayedPhoto = onDisplayedPhoto
         self.finished = False
         self.statusPort = statusPort
         self.ingesterThread = threading.Thread(target=self._runIngester)
@@ -29,22 +33,29 @@ class SlideshowInterface:
                 self.displayedPhotos.insert(0, msg["params"])
                 if (len(self.displayedPhotos) > 50):
                     self.displayedPhotos.pop()
+                if self.onDisplayedPhoto is not None:
+                    try:
+                        self.onDisplayedPhoto(msg["params"])
+                    except Exception as e:
+                        logging.error(f'Failed to record displayed photo {msg["params"]}: {e}')
 
     def report(self, status, numTotalPhotos, numProcessedPhotos, numFailedPhotos):
-        res = self.commandSocket.send_json({
-            "status": status,
-            "numTotalPhotos": numTotalPhotos,
-            "numProcessedPhotos": numProcessedPhotos,
-            "numFailedPhotos": numFailedPhotos
-        })
+        with self.sendLock:
+            res = self.commandSocket.send_json({
+                "status": status,
+                "numTotalPhotos": numTotalPhotos,
+                "numProcessedPhotos": numProcessedPhotos,
+                "numFailedPhotos": numFailedPhotos
+            })
         logging.info("StatusReporter: %s" % res)
 
     def sendCommand(self, command, params):
         logging.info("Sending command %s with params %s to slideshow" % (command, params))
-        res = self.commandSocket.send_json({
-            "command": command,
-            "params": params
-        })
+        with self.sendLock:
+            res = self.commandSocket.send_json({
+                "command": command,
+                "params": params
+            })
         logging.info("CommandSender: %s" % res)
 
     def cleanup(self):
@@ -10,8 +10,9 @@ import threading
 from io import BytesIO
 from PIL import Image, ImageOps
 
-from ImmichDownloader import ImmichDownloader
-from Constants import CONFIG_LOG_TO_FILE, CONFIG_SERVER_SOCKET, CONFIG_THUMBNAIL_DIR, CONFIG_WORKING_DIR, STATUS_CHANGED_EVENT
+from ImmichDownloader import createImmichDownloader
+from CacheLayout import CacheLayout
+from Constants import CONFIG_LOG_TO_FILE, CONFIG_SERVER_SOCKET, CONFIG_SHARDED_CACHE, CONFIG_THUMBNAIL_DIR, CONFIG_WORKING_DIR, STATUS_CHANGED_EVENT
 
 class RegexConverter(BaseConverter):
     def __init__(self, url_map, *items):
@@ -94,6 +95,8 @@ def downloader_status():
         'numPhotos': frontEnd.fetcher.numPhotosInAlbum,
         'numPhotosProcessed': frontEnd.fetcher.numPhotosProcessed,
         'cacheUsePercent': frontEnd.fetcher.cacheUsePercent,
+        'requestRate': frontEnd.downloader.requestRate,
+        'renditions': getattr(frontEnd.downloader, 'renditionStats', {}),
     })
 
 @webApp.route('/api/displayed_list', methods=['GET'])
@@ -102,13 +105,14 @@ def displayed_list():
     return json.dumps(frontEnd.fetcher.displayedList)
 
 def get_thumbnail(name):
-    global workingDir
-    global thumbnailDir
-    filepath = path.join(workingDir, name)
-    thumbPath = path.join(thumbnailDir, name)
+    global photoLayout
+    global thumbnailLayout
+    filepath = photoLayout.resolve(name)
+    thumbPath = thumbnailLayout.resolve(name)
 
     if path.exists(thumbPath):
         return thumbPath
+    thumbPath = thumbnailLayout.pathFor(name)
 
     with open(filepath, 'rb') as f:            
         image = Image.open(BytesIO(f.read()))
@@ -191,11 +195,13 @@ patch_threading_excepthook()
 frontEnd = None
 workingDir = None
 thumbnailDir = None
+photoLayout: CacheLayout = None
+thumbnailLayout: CacheLayout = None
 downloader = None
 
 def main():
     # setup major parts of the system
-    global frontEnd, workingDir, thumbnailDir, downloader
+    global frontEnd, workingDir, thumbnailDir, photoLayout, thumbnailLayout, downloader
 
     config = None
     configPath = path.join(path.dirname(path.realpath(__file__)), "../config.json")
@@ -207,6 +213,9 @@ def main():
         thumbnailDir = config[CONFIG_THUMBNAIL_DIR]
         if not path.exists(thumbnailDir):
             mkdir(thumbnailDir)
+        sharded = CONFIG_SHARDED_CACHE in config and config[CONFIG_SHARDED_CACHE]
+        photoLayout = CacheLayout(workingDir, sharded)
+        thumbnailLayout = CacheLayout(thumbnailDir, sharded)
 
     if logToFile:
         filePath = path.join(path.dirname(path.realpath(__file__)), f"../logs/server_{datetime.now().strftime('%Y-%m-%d--%H-%M')}.log")
@@ -214,7 +223,7 @@ def main():
     else:
         logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(message)s')
     logging.info("Starting server")
-    downloader = ImmichDownloader(config)
+    downloader = createImmichDownloader(config)
     downloader.on(STATUS_CHANGED_EVENT, downloaderStatusChanged)
     fetcher = PhotoProcessor(downloader, config)
     frontEnd = WebFrontEnd(fetcher)
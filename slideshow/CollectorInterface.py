@@ -5,6 +5,7 @@ import logging
 import subprocess
 from os import path
 from ScreenSaver import ScreenSaver
+from PhotoIndex import PhotoIndex
 class CollectorInterface:
     state: bool = False
     totalPhotos: int = 0
@@ -15,9 +16,11 @@ class CollectorInterface:
     collectorThread: threading.Thread = None
     loggingPort: int = 0
     screenSaver: ScreenSaver
-    def __init__(self, statusPort, loggingPort, screenSaver,  autoLaunchCollector=True):
+    photoIndex: PhotoIndex = None
+    def __init__(self, statusPort, loggingPort, screenSaver,  autoLaunchCollector=True, photoIndex=None):
         self.statusPort = statusPort
         self.screenSaver = screenSaver
+        self.photoIndex = photoIndex
         # start the status ingester
         self.ingesterThread = threading.Thread(target=self.runIngester)
         self.ingesterThread.start()
@@ -73,6 +76,10 @@ class CollectorInterface:
                         self.screenSaver.turnOnScreen()
                     else:
                         self.screenSaver.turnOffScreen()
+                elif packet["command"] == "photoAdded" and self.photoIndex is not None:
+                    self.photoIndex.add(packet["params"]["file"], packet["params"]["metadata"])
+                elif packet["command"] == "photoRemoved" and self.photoIndex is not None:
+                    self.photoIndex.remove(packet["params"])
 
     def cleanup(self):
         self.finished = True
@@ -0,0 +1,114 @@
+import json
+import logging
+import sqlite3
+import threading
+from os import path
+from random import randrange
+from time import sleep
+
+import ServerModules
+from CacheLayout import CacheLayout
+
+class PhotoIndex:
+    # The photos the slideshow can pick from, kept in memory so choosing the next
+    # slide doesn't touch the disk. The collector tells us about photos being
+    # added and removed; a periodic scan catches anything we missed (e.g. while
+    # the collector was restarting). photos is a list for O(1) random picks and
+    # positions maps each name to its place in it for O(1) removal. metadata holds
+    # what the collector recorded for display (date, number of faces), which
+    # comes with the add notification or, on a scan, from the cache manifest.
+    def __init__(self, layout: CacheLayout, reconcileSecs: float = 600, manifestPath: str = None) -> None:
+        self.layout = layout
+        self.reconcileSecs = reconcileSecs
+        self.manifestPath = manifestPath
+        self.photos = []
+        self.positions = dict()
+        self.metadata = dict()
+        self.lock = threading.Lock()
+        self.finished = False
+        self.reconcile()
+        self.reconcileThread = threading.Thread(target=self._run_reconcile, name="index-reconcile", daemon=True)
+        self.reconcileThread.start()
+
+    def __len__(self):
+        return len(self.photos)
+
+    def __contains__(self, photo: str):
+        return photo in self.positions
+
+    def add(self, photo: str, metadata = None):
+        if not photo.endswith(".JPEG"):
+            return
+        with self.lock:
+            if metadata is not None:
+                self.metadata[photo] = metadata
+            if photo not in self.positions:
+                self.positions[photo] = len(self.photos)
+                self.photos.append(photo)
+
+    def remove(self, photo: str):
+        with self.lock:
+            if photo not in self.positions:
+                return
+            # move the last photo into the gap
+            position = self.positions.pop(photo)
+            self.metadata.pop(photo, None)
+            last = self.photos.pop()
+            if last != photo:
+                self.photos[position] = last
+                self.positions[last] = position
+
+    def choice(self):
+        # returns (photo, position), or (None, 0) if there's nothing to show
+        with self.lock:
+            if len(self.photos) == 0:
+                return None, 0
+            position = randrange(len(self.photos))
+            return self.photos[position], position
+
+    def getMetadata(self, photo: str):
+        return self.metadata.get(photo)
+
+    def reconcile(self):
+        onDisk = set(file for file, fullPath in self.layout.listFiles() if file.endswith(".JPEG"))
+        metadata = self._read_manifest()
+        with self.lock:
+            missing = [photo for photo in self.photos if photo not in onDisk]
+            new = [photo for photo in onDisk if photo not in self.positions]
+        # the collector keeps adding and removing photos while we scan, so check
+        # again before acting on what the scan saw
+        missing = [photo for photo in missing if not self.layout.exists(photo)]
+        new = [photo for photo in new if self.layout.exists(photo)]
+        for photo in missing:
+            self.remove(photo)
+        for photo in new:
+            self.add(photo, metadata.get(photo))
+        with self.lock:
+            # and anything whose add notification we never got
+            for photo in self.photos:
+                if photo not in self.metadata and photo in metadata:
+                    self.metadata[photo] = metadata[photo]
+        logging.info(f'Photo index has {len(self.photos)} photos, {len(new)} added and {len(missing)} removed by scan')
+
+    def _read_manifest(self):
+        # file name -> display metadata, for everything the collector recorded it for
+        if self.manifestPath is None or not path.exists(self.manifestPath):
+            return dict()
+        try:
+            manifest = sqlite3.connect(self.manifestPath)
+            try:
+                rows = manifest.execute("SELECT file, metadata FROM files WHERE metadata IS NOT NULL").fetchall()
+            finally:
+                manifest.close()
+        except sqlite3.Error as e:
+            logging.error(f'Could not read display metadata from {self.manifestPath}: {e}')
+            return dict()
+        return {file: json.loads(metadata) for file, metadata in rows}
+
+    def _run_reconcile(self):
+        while not self.finished:
+            sleep(self.reconcileSecs)
+            try:
+                self.reconcile()
+            except Exception as e:
+                logging.error(f'Photo index scan failed: {e}')
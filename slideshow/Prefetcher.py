@@ -0,0 +1,77 @@
+import logging
+import threading
+from collections import deque
+from time import sleep
+from typing import Callable
+
+import pygame
+
+from PhotoIndex import PhotoIndex
+
+class Slide:
+    def __init__(self, name: str, surface: pygame.Surface, total: int, number: int) -> None:
+        self.name = name
+        self.surface = surface
+        self.total = total
+        self.number = number
+        self.bytes = surface.get_pitch() * surface.get_height()
+
+class Prefetcher:
+    # Renders the next few slides on a background thread, so the slideshow loop
+    # only has to blit when a slide is due. Stops once it holds depth slides or
+    # maxBytes worth of surfaces, whichever comes first, but always keeps at
+    # least one ready.
+    def __init__(self, index: PhotoIndex, render: Callable[[], Slide], depth: int = 3, maxBytes: int = 64 << 20) -> None:
+        self.index = index
+        self.render = render
+        self.depth = max(1, depth)
+        self.maxBytes = maxBytes
+        self.slides = deque()
+        self.bytes = 0
+        self.condition = threading.Condition()
+        self.finished = False
+        self.thread = threading.Thread(target=self._run, name="prefetcher", daemon=True)
+        self.thread.start()
+
+    def _full(self):
+        return len(self.slides) >= self.depth or (len(self.slides) > 0 and self.bytes >= self.maxBytes)
+
+    def _run(self):
+        while not self.finished:
+            with self.condition:
+                while not self.finished and self._full():
+                    self.condition.wait()
+            if self.finished:
+                return
+            try:
+                slide = self.render()
+            except Exception as e:
+                logging.error(f'Prefetch failed: {e}')
+                slide = None
+            if slide is None:
+                # nothing to show yet
+                sleep(1)
+                continue
+            with self.condition:
+                self.slides.append(slide)
+                self.bytes += slide.bytes
+                self.condition.notify_all()
+
+    def next(self, timeout: float) -> Slide:
+        # the next slide, or None if none was ready within timeout. Slides whose
+        # photo has left the index since they were rendered are dropped
+        with self.condition:
+            while True:
+                if len(self.slides) == 0 and not self.condition.wait_for(lambda: len(self.slides) > 0, timeout):
+                    return None
+                slide = self.slides.popleft()
+                self.bytes -= slide.bytes
+                self.condition.notify_all()
+                if slide.name in self.index:
+                    return slide
+
+    def cleanup(self):
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+        self.thread.join()
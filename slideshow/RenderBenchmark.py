@@ -0,0 +1,70 @@
+# Times getting a decoded photo onto the screen with the old path (fromstring,
+# convert, full fill, blit) against toSurface/drawSlide. Runs headless on SDL's
+# dummy video driver, so it works over ssh on the frame itself. Allocations are
+# what Python's tracemalloc sees per frame: the pixel buffers handed between PIL
+# and pygame, not SDL's own surfaces.
+#
+#   python RenderBenchmark.py --screen 1280x800 --photo 1200x800 --frames 50
+
+import argparse
+import os
+import statistics
+import time
+import tracemalloc
+
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+
+import pygame
+from PIL import Image
+
+from Surfaces import drawSlide, pixelFormat, toSurface
+
+def legacyFrame(screen, img):
+    image = pygame.image.fromstring(img.tobytes(), img.size, img.mode)
+    image = image.convert()
+    tsize = screen.get_size()
+    screen.fill([0,0,0])
+    ssize = img.size
+    screen.blit(image, [(tsize[0]-ssize[0])/2,(tsize[1]-ssize[1])/2])
+
+def surfaceFrame(screen, img):
+    drawSlide(screen, toSurface(img, pixelFormat(screen)))
+
+def measure(name, frame, screen, img, frames):
+    times = []
+    allocated = []
+    for _ in range(frames):
+        tracemalloc.start()
+        start = time.perf_counter()
+        frame(screen, img)
+        pygame.display.flip()
+        times.append(time.perf_counter() - start)
+        allocated.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    times.sort()
+    print(f"{name:>8} {statistics.mean(times) * 1000:10.2f} {times[int(len(times) * 0.95) - 1] * 1000:10.2f} {statistics.mean(allocated) / (1 << 20):12.2f}")
+
+def size(value):
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--screen", type=size, default=(1280, 800))
+    parser.add_argument("--photo", type=size, default=(1200, 800))
+    parser.add_argument("--depth", type=int, default=32, help="display bits per pixel, 16 for RGB565 panels")
+    parser.add_argument("--frames", type=int, default=50)
+    args = parser.parse_args()
+
+    pygame.display.init()
+    screen = pygame.display.set_mode(args.screen, 0, args.depth)
+    img = Image.frombytes("RGB", args.photo, os.urandom(args.photo[0] * args.photo[1] * 3))
+    print(f"{pygame.display.get_driver()} display {args.screen[0]}x{args.screen[1]}@{screen.get_bitsize()}bpp, photo {args.photo[0]}x{args.photo[1]}")
+
+    print(f"{'':>8} {'mean(ms)':>10} {'p95(ms)':>10} {'alloc(MB)':>12}")
+    measure("legacy", legacyFrame, screen, img, args.frames)
+    measure("surface", surfaceFrame, screen, img, args.frames)
+    pygame.display.quit()
+
+if __name__ == "__main__":
+    main()
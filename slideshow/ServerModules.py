@@ -0,0 +1,10 @@
+# The slideshow shares the cache layout and frame format with the collector.
+# Importing this puts the collector's folder on the module path, found from
+# where this file is rather than the current directory, so the slideshow can
+# be started from anywhere.
+import sys
+from os import path
+
+serverDir = path.join(path.dirname(path.realpath(__file__)), "..", "server")
+if serverDir not in sys.path:
+    sys.path.append(serverDir)
@@ -0,0 +1,77 @@
+import mmap
+
+import pygame
+from PIL import Image
+
+import ServerModules
+from FrameFormat import FRAME_HEADER, FRAME_MAGIC
+
+def pixelFormat(screen: pygame.Surface):
+    # the display's pixel format, as (bits per pixel, masks). Read it on the main
+    # thread once the mode is set, and hand it to the functions below
+    return screen.get_bitsize(), screen.get_masks()
+
+def inFormat(surface: pygame.Surface, format) -> pygame.Surface:
+    # a copy of surface in the given pixel format, so blitting it to the screen
+    # is a plain copy. Unlike convert() this never touches the display, so it's
+    # safe on the prefetch thread
+    bits, masks = format
+    converted = pygame.Surface(surface.get_size(), 0, bits, masks)
+    converted.blit(surface, (0, 0))
+    return converted
+
+def toSurface(img: Image, format) -> pygame.Surface:
+    # PIL can't lend out its pixels, so tobytes() copies them once. frombuffer
+    # wraps that copy where fromstring would make another, and converting to the
+    # display's pixel format is the only other copy
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGB")
+    return inFormat(pygame.image.frombuffer(img.tobytes(), img.size, img.mode), format)
+
+def drawSlide(screen: pygame.Surface, surface: pygame.Surface, color = (0, 0, 0)):
+    # photos are rendered to the screen size at ingest, so mostly they cover the
+    # whole screen and there's nothing to clear. Otherwise only clear the bars
+    screenSize = screen.get_size()
+    size = surface.get_size()
+    x = (screenSize[0] - size[0]) // 2
+    y = (screenSize[1] - size[1]) // 2
+    if x > 0:
+        screen.fill(color, (0, 0, x, screenSize[1]))
+        screen.fill(color, (x + size[0], 0, screenSize[0] - x - size[0], screenSize[1]))
+    if y > 0:
+        screen.fill(color, (0, 0, screenSize[0], y))
+        screen.fill(color, (0, y + size[1], screenSize[0], screenSize[1] - y - size[1]))
+    screen.blit(surface, (x, y))
+
+def frameSurface(fullPath: str, format) -> pygame.Surface:
+    # map a raw frame written by the collector and copy its pixels straight into
+    # a surface, then convert that to the display's format (a plain copy when the
+    # frame is already in it). None if there's no usable frame
+    try:
+        with open(fullPath, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as frame:
+            if len(frame) < FRAME_HEADER.size:
+                return None
+            magic, width, height, bytesPerPixel = FRAME_HEADER.unpack_from(frame)
+            if magic != FRAME_MAGIC or len(frame) != FRAME_HEADER.size + width * bytesPerPixel * height:
+                return None
+            return _mappedSurface(frame, width, height, bytesPerPixel, format)
+    except (FileNotFoundError, ValueError, BufferError):
+        return None
+
+def _mappedSurface(frame: mmap.mmap, width: int, height: int, bytesPerPixel: int, format) -> pygame.Surface:
+    # everything pointing into the map is local to this function, so it's all
+    # gone by the time frameSurface closes the map
+    pixels = memoryview(frame)[FRAME_HEADER.size:]
+    if bytesPerPixel == 3:
+        return inFormat(pygame.image.frombuffer(pixels, (width, height), "RGB"), format)
+    surface = pygame.Surface((width, height), 0, 16, (0xF800, 0x07E0, 0x001F, 0))
+    rowBytes = width * bytesPerPixel
+    pitch = surface.get_pitch()
+    with memoryview(surface.get_buffer()).cast("B") as view:
+        if pitch == rowBytes:
+            view[:rowBytes * height] = pixels
+        else:
+            # rows are padded in the surface
+            for row in range(height):
+                view[row * pitch:row * pitch + rowBytes] = pixels[row * rowBytes:(row + 1) * rowBytes]
+    return inFormat(surface, format)
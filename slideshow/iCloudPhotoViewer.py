@@ -8,13 +8,19 @@ import asyncio
 import logging
 from datetime import datetime
 import os
-import glob
-from time import sleep
-from random import choice
+from time import sleep, monotonic
+# the collector owns the cache layout, share its path resolver
+import ServerModules
 from CollectorInterface import CollectorInterface
 import sys
+from CacheLayout import CacheLayout
+from PhotoIndex import PhotoIndex
+from Prefetcher import Prefetcher, Slide
+from Surfaces import drawSlide, frameSurface, pixelFormat, toSurface
+from FrameFormat import FRAME_FORMATS, frameName
 import threading
 import piexif
+from functools import lru_cache
 
 screenSaver = None
 timeoutEvent : asyncio.Event = None
@@ -51,37 +57,122 @@ def drawOnImage(image: Image, text: str, coordinates, font: ImageFont.FreeTypeFo
     draw.text([coordinates[0], coordinates[1]], text, fill=(255,222,000), font=font)
     return draw
 
-def drawStatus(image: Image, screenSize, collector: CollectorInterface, font: ImageFont.FreeTypeFont, emboss: bool):
-    draw = drawOnImage(image, f'{collector.numProcessedPhotos}/{collector.numTotalPhotos}', (40, screenSize[1] - 20), font, emboss)
+def drawStatus(image: Image, screenSize, processed: int, total: int, working: bool, font: ImageFont.FreeTypeFont, emboss: bool):
+    draw = drawOnImage(image, f'{processed}/{total}', (40, screenSize[1] - 20), font, emboss)
     size = draw.textsize("123", font=font)
     offset = max(size[1], 5)
  
-    if collector.status:
+    if working:
         fill = "green"
     else:
         fill = "red"
     draw.ellipse((20, screenSize[1] - 20, 20 + offset, screenSize[1] - 20 + offset), fill=fill)
 
-def fileName(fullPath):
-    return path.basename(fullPath)
-
-def nextPhoto(workingDir) -> Image:
+def nextPhoto(index: PhotoIndex) -> Image:
     # return a random image from the ones already on disk
     try:
-        photos = list(map(fileName, glob.glob(workingDir + "/*.JPEG")))
-        if len(photos) == 0:
+        photo, number = index.choice()
+        if photo is None:
             logging.info('No photos found in library')
             return None, 0, 0, ""
-     #   logging.info(f'Found {len(photos)} photos in library')
 
-        photo = choice(photos)
       #  logging.info(f'Selected {photo}')
-        img = Image.open(path.join(workingDir, photo))
-        return img, len(photos), photos.index(photo), photo
+        try:
+            img = Image.open(index.layout.resolve(photo))
+        except FileNotFoundError:
+            # removed before we heard about it
+            index.remove(photo)
+            return None, 0, 0, ""
+        return img, len(index), number, photo
     except Exception as e:
         logging.error(f'Error selecting photo: {e}')
         return None, 0, 0, ""
 
+def metadataCaption(metadata) -> str:
+    # from what the collector recorded when it rendered the photo. The date is in
+    # EXIF's format like the photo's own, or ISO-8601 in manifests from before
+    # the collector normalised it
+    dateTime = ""
+    if metadata.get("date"):
+        try:
+            date = datetime.strptime(metadata["date"], '%Y:%m:%d %H:%M:%S')
+        except ValueError:
+            try:
+                date = datetime.fromisoformat(metadata["date"].replace("Z", "+00:00"))
+                if date.tzinfo is not None:
+                    date = date.astimezone()
+            except ValueError:
+                date = None
+                logging.error(f"Could not parse date {metadata['date']}")
+        if date is not None:
+            dateTime = date.strftime('%d %b %Y %H:%M')
+    return f"{dateTime}, F: {metadata.get('faces', 0)}"
+
+def photoCaption(img: Image) -> str:
+    # for photos rendered before the collector recorded display metadata. Image.open
+    # only reads the header, so this works without decoding the photo
+    try:
+        exif_dict = piexif.load(img.info["exif"])
+        if "Exif" in exif_dict:
+            exif = exif_dict["Exif"]
+            if piexif.ExifIFD.DateTimeOriginal in exif:
+                dateTime = exif[piexif.ExifIFD.DateTimeOriginal]
+                dateTime = datetime.strptime(str(dateTime, 'utf-8'), '%Y:%m:%d %H:%M:%S')
+                dateTime = dateTime.strftime('%d %b %Y %H:%M')
+            else:
+                dateTime = ""
+            if piexif.ExifIFD.SubjectArea in exif:
+                numFaces = exif[piexif.ExifIFD.SubjectArea]
+            else:
+                numFaces = 0
+        else:
+            numFaces = 0
+            dateTime = ""
+    except Exception as e:
+        logging.error(f"Could not read EXIF data: {e}")
+        numFaces = 0
+        dateTime = ""
+    return f"{dateTime}, F: {numFaces}"
+
+@lru_cache(maxsize=256)
+def captionSurface(text: str, width: int, font: ImageFont.FreeTypeFont) -> pygame.Surface:
+    # drawn on a transparent strip to go along the bottom of the photo. Photos come
+    # round again, so keep the most recent ones rather than drawing text each time.
+    # Only ever blitted onto slides on the prefetch thread, so it stays a plain
+    # RGBA surface rather than being converted for the display
+    strip = Image.new("RGBA", (width, 60), (0, 0, 0, 0))
+    drawOnImage(strip, text, [width - 200, 0], font, True)
+    return pygame.image.fromstring(strip.tobytes(), strip.size, strip.mode)
+
+def renderSlide(index: PhotoIndex, frames: CacheLayout, font: ImageFont.FreeTypeFont, format) -> Slide:
+    # runs on the prefetch thread: pick the next photo and get it into a surface
+    # in the display's pixel format, from the raw frame the collector wrote if
+    # there is one, otherwise by decoding the JPEG. Then adorn it. Nothing here
+    # may touch the display, that's for the main thread only
+    img, total, number, name = nextPhoto(index)
+    if img == None:
+        return None
+    surface = None
+    if frames is not None:
+        surface = frameSurface(frames.resolve(frameName(name)), format)
+    if surface is None:
+        surface = toSurface(img, format)
+    if font is not None:
+        metadata = index.getMetadata(name)
+        text = metadataCaption(metadata) if metadata is not None else photoCaption(img)
+        caption = captionSurface(text, surface.get_width(), font)
+        surface.blit(caption, [0, surface.get_height() - caption.get_height()])
+    return Slide(name, surface, total, number)
+
+@lru_cache(maxsize=8)
+def statusSurface(width: int, processed: int, total: int, working: bool, font: ImageFont.FreeTypeFont) -> pygame.Surface:
+    # the status changes while slides wait in the prefetcher, so it's drawn on a
+    # strip along the bottom of the screen when the slide goes up. It only changes
+    # while the collector is working, so it's rarely redrawn
+    strip = Image.new("RGBA", (width, 60), (0, 0, 0, 0))
+    drawStatus(strip, strip.size, processed, total, working, font, True)
+    return pygame.image.fromstring(strip.tobytes(), strip.size, strip.mode).convert_alpha()
+
 def slideshow():
     global timeoutEvent  
     timeoutEvent = asyncio.Event()
@@ -100,6 +191,28 @@ def slideshow():
         loggingPort = obj["loggingSocket"]
         showStatus = obj["showStatus"]
         autoLaunchCollector = obj["autoLaunchCollector"]
+        sharded = "shardedCache" in obj and obj["shardedCache"]
+        if "indexReconcileSecs" in obj:
+            indexReconcileSecs = obj["indexReconcileSecs"]
+        else:
+            indexReconcileSecs = 600
+        if "prefetchCount" in obj:
+            prefetchCount = obj["prefetchCount"]
+        else:
+            prefetchCount = 3
+        if "prefetchMemoryMb" in obj:
+            prefetchMemoryMb = obj["prefetchMemoryMb"]
+        else:
+            prefetchMemoryMb = 64
+        rawFrames = "rawFrames" in obj and obj["rawFrames"] in FRAME_FORMATS
+        if "dataDir" in obj:
+            dataDir = obj["dataDir"]
+        else:
+            dataDir = path.join(path.dirname(path.realpath(__file__)), "../data")
+        manifestPath = path.join(dataDir, "cache.db")
+
+    layout = CacheLayout(workingDir, sharded)
+    frames = CacheLayout(path.join(workingDir, "frames"), sharded) if rawFrames else None
 
     screenSaver = ScreenSaver(sensorPin, relayPin, timeout, timeoutEvent)
                  
@@ -114,6 +227,8 @@ def slideshow():
     logging.info(pygame.display.get_driver())
     logging.info(pygame.display.Info())
     tsize = screen.get_size()
+    screenFormat = pixelFormat(screen)
+    myfontLarge = None
     if adornPhotos:
         try:
             myfontLarge = ImageFont.truetype("/usr/share/fonts/truetype/freefont/FreeSans.ttf", 25)
@@ -128,7 +243,12 @@ def slideshow():
     logging.info("SLIDESHOW: Starting slideshow")
 
     # start the interface with the collector process
-    collector = CollectorInterface(statusPort, loggingPort, screenSaver, autoLaunchCollector)
+    index = PhotoIndex(layout, indexReconcileSecs, manifestPath)
+    collector = CollectorInterface(statusPort, loggingPort, screenSaver, autoLaunchCollector, index)
+
+    # slides are decoded ahead of time, so putting one up is just a blit
+    prefetcher = Prefetcher(index, lambda: renderSlide(index, frames, myfontLarge, screenFormat), prefetchCount, prefetchMemoryMb << 20)
+    nextSlideTime = monotonic()
 
     while(True):
         try:
@@ -138,52 +258,27 @@ def slideshow():
                         return
                 except ValueError:
                     continue
-            img, total, number, name = nextPhoto(workingDir)
-            if img == None:
-                sleep(delaySecs)
+            slide = prefetcher.next(delaySecs)
+            if slide == None:
                 continue
-           
-            if adornPhotos:
-                try:
-                    exif_dict = piexif.load(img.info["exif"])
-                    if "Exif" in exif_dict:
-                        exif = exif_dict["Exif"]
-                        if piexif.ExifIFD.DateTimeOriginal in exif:
-                            dateTime = exif[piexif.ExifIFD.DateTimeOriginal]
-                            dateTime = datetime.strptime(str(dateTime, 'utf-8'), '%Y:%m:%d %H:%M:%S')
-                            dateTime = dateTime.strftime('%d %b %Y %H:%M')
-                        else:
-                            dateTime = ""
-                        if piexif.ExifIFD.SubjectArea in exif:
-                            numFaces = exif[piexif.ExifIFD.SubjectArea]
-                        else:
-                            numFaces = 0
-                    else:
-                        numFaces = 0
-                        dateTime = ""
-                except Exception as e:
-                    logging.error(f"Could not read EXIF data: {e}")
-                    numFaces = 0
-                    dateTime = ""
-                drawOnImage(img, f"{dateTime}, F: {numFaces}", [tsize[0] - 200, tsize[1] - 60], myfontLarge, True)
-                drawStatus(img, tsize, collector, myfontSmall, True)
-
-            # convert to pygame image
-            image = pygame.image.fromstring(img.tobytes(), img.size, img.mode)
-            image = image.convert()
+
+            # hold the slide until it's due
+            sleep(max(0, nextSlideTime - monotonic()))
 
             # center and draw
-            screen.fill([0,0,0])
-            ssize = img.size
-            screen.blit(image, [(tsize[0]-ssize[0])/2,(tsize[1]-ssize[1])/2])
+            drawSlide(screen, slide.surface)
+            if adornPhotos:
+                status = statusSurface(tsize[0], collector.numProcessedPhotos, collector.numTotalPhotos, collector.status, myfontSmall)
+                screen.blit(status, [0, tsize[1] - 60])
             pygame.display.flip() # display update
+            nextSlideTime = monotonic() + delaySecs
             event = pygame.event.wait(100)
             if event != pygame.NOEVENT and event.type == pygame.KEYDOWN:
+                prefetcher.cleanup()
                 collector.cleanup()
                 cleanup()
             pygame.event.clear()
-            collector.reportDisplayedPhoto(name)
-            sleep(delaySecs)
+            collector.reportDisplayedPhoto(slide.name)
         except Exception as e:
             logging.error(f"SLIDESHOW: Error: {e}. Continuing.")
 